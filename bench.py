@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Replay benchmarks for the message handling hot path. Builds synthetic hives
+# of various sizes, drives the client handlers with generated (or recorded)
+# IRC lines and writes the numbers out as JSON so runs can be compared
+# between commits.
+
+from collections import namedtuple
+from datetime import datetime
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+import socky
+from hive import open_hive, shard_key
+from workers import InlinePool
+
+Hostmask = namedtuple('Hostmask', 'nick username host')
+Line = namedtuple('Line', 'hostmask command params')
+
+def parse_line(text):
+    # Just enough of RFC1459 for replaying logs
+    hostmask = None
+    if text.startswith(':'):
+        prefix, _, text = text[1:].partition(' ')
+        nick, _, rest = prefix.partition('!')
+        username, _, host = rest.partition('@')
+        hostmask = Hostmask(nick, username, host)
+
+    text, sep, trailing = text.partition(' :')
+    params = text.split()
+    command = params.pop(0).upper()
+    if sep: params.append(trailing)
+
+    return Line(hostmask, command, params)
+
+class BenchClient(socky.SockyIRCClient):
+    # Never connects; everything it would send is counted instead.
+
+    def __init__(self, **kwargs):
+        self.nick = self.current_nick = kwargs.get('nick', 'Socky')
+        self.isupport = {'CHANTYPES' : '#&'}
+        self.users = {}
+        self.dispatch = {}
+        self.sent = 0
+
+        self.setup_socky(**kwargs)
+
+        # Do lookups inline so the timings include them
+        self.workers.close()
+        self.workers = InlinePool()
+
+        # And no flood protection
+        self.sendqueue.burst = self.sendqueue.tokens = float('inf')
+
+    def add_dispatch_in(self, command, priority, func):
+        self.dispatch[command] = func
+
+    def cmdwrite(self, command, params):
+        self.sent += 1
+
+    def ctcpwrite(self, target, command, params=''):
+        self.sent += 1
+
+    def deferred(self, callback):
+        # Everything's inline and there's no read loop to drain a queue
+        return callback
+
+    def timer_oneshot(self, name, delay, func):
+        # Spew straight away; the delay is just for show
+        func()
+
+    def nickchan_lower(self, name):
+        return name.lower()
+
+def make_words(rng, count):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+            for _ in range(count)]
+
+def build_hive(path, size, seed=0):
+    rng = random.Random(seed)
+    words = make_words(rng, max(size // 4, 500))
+
+    hive = open_hive(path)
+    writers = {}
+    now = datetime.now()
+    for i in range(size):
+        querytype = rng.choice(('LITERAL', 'MATCHALL', 'FUZZY', 'FUZZY'))
+        if i % 100 == 0:
+            querytype = rng.choice(('JOIN', 'EXIT'))
+
+        trigger = ' '.join(rng.sample(words, rng.randint(1, 3)))
+        fields = dict(trigger=trigger, querytype=querytype,
+                      response='response {} for {{who}}'.format(i),
+                      useaction=(i % 7 == 0), who='bench', time=now)
+
+        key = shard_key(fields)
+        if key not in writers:
+            writers[key] = hive.get(key, create=True).writer(limitmb=64)
+        writers[key].add_document(**fields)
+
+    for writer in writers.values():
+        writer.commit(optimize=True)
+    hive.close()
+
+    return words
+
+def make_lines(words, count, channels=10, seed=1):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        nick = 'user{}'.format(rng.randint(1, 200))
+        prefix = ':{0}!{0}@bench.example '.format(nick)
+        channel = '#chan{}'.format(rng.randint(1, channels))
+
+        kind = rng.random()
+        if kind < 0.9:
+            # Zipf-ish chatter so some lines repeat
+            length = rng.randint(1, 15)
+            text = ' '.join(words[int(rng.paretovariate(1.2)) % len(words)]
+                            for _ in range(length))
+            lines.append(prefix + 'PRIVMSG {} :{}'.format(channel, text))
+        elif kind < 0.95:
+            lines.append(prefix + 'JOIN {}'.format(channel))
+        elif kind < 0.98:
+            lines.append(prefix + 'PART {} :bye'.format(channel))
+        else:
+            lines.append(prefix + 'QUIT :Quit: bye')
+
+    return lines
+
+def percentile(values, pct):
+    if not values: return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+def summarise(timings):
+    total = sum(timings)
+    return {
+        'count' : len(timings),
+        'p50_us' : percentile(timings, 50) * 1e6,
+        'p99_us' : percentile(timings, 99) * 1e6,
+        'max_us' : max(timings) * 1e6 if timings else 0,
+        'per_sec' : len(timings) / total if total else 0,
+    }
+
+def run_size(size, lines, workdir, queue):
+    hivepath = os.path.join(workdir, 'index-{}'.format(size))
+    start = time.time()
+    if not os.path.exists(hivepath):
+        words = build_hive(hivepath, size)
+    else:
+        words = make_words(random.Random(0), max(size // 4, 500))
+    buildtime = time.time() - start
+
+    start = time.time()
+    socky.setup(hivepath)
+    loadtime = time.time() - start
+
+    client = BenchClient(db=os.path.join(workdir, 'db-{}'.format(size)))
+    # Never hold back, we want every line to go all the way through
+    client.config['interval'] = 0
+
+    if lines is None:
+        lines = make_lines(words, 20000)
+    lines = [parse_line(l) for l in lines]
+
+    timings = {}
+    selects = []
+    for line in lines:
+        handler = client.dispatch.get(line.command)
+        if not handler: continue
+
+        start = time.perf_counter()
+        handler(None, line)
+        timings.setdefault(line.command, []).append(time.perf_counter() - start)
+
+        if line.command == 'PRIVMSG':
+            message = line.params[-1]
+            candidates = socky.matcher.match(message)
+            start = time.perf_counter()
+            socky.select_query(message, candidates)
+            selects.append(time.perf_counter() - start)
+
+    client.writer.close()
+
+    result = {
+        'size' : size,
+        'build_sec' : buildtime,
+        'load_sec' : loadtime,
+        'responses' : client.sent,
+        'select_query' : summarise(selects),
+        'handlers' : {k : summarise(v) for k, v in timings.items()},
+        'peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'matcher_memory' : socky.matcher.memory(),
+    }
+    queue.put(result)
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmark the message '
+                                        'handling hot path')
+    argparser.add_argument('--sizes', default='1000,100000',
+                           help='comma separated hive sizes, e.g. '
+                           '1000,100000,1000000')
+    argparser.add_argument('--replay', default=None,
+                           help='file of raw IRC lines to replay instead of '
+                           'generated traffic')
+    argparser.add_argument('--workdir', default=None,
+                           help='keep generated hives here between runs')
+    argparser.add_argument('--output', default='bench.json',
+                           help='where to write the JSON results')
+    args = argparser.parse_args()
+
+    lines = None
+    if args.replay:
+        with open(args.replay, encoding='utf-8', errors='replace') as f:
+            lines = [l.rstrip('\r\n') for l in f if l.strip()]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='socky-bench-')
+    os.makedirs(workdir, exist_ok=True)
+
+    results = []
+    try:
+        for size in [int(x) for x in args.sizes.split(',')]:
+            # One process per size so peak RSS means something
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=run_size,
+                                           args=(size, lines, workdir, queue))
+            proc.start()
+            result = queue.get()
+            proc.join()
+
+            results.append(result)
+            privmsg = result['handlers'].get('PRIVMSG', {})
+            print('{size} triggers: PRIVMSG p50 {p50:.1f}us p99 {p99:.1f}us '
+                  '{rate:.0f} msg/s, peak RSS {rss} KB'.format(
+                      size=size, p50=privmsg.get('p50_us', 0),
+                      p99=privmsg.get('p99_us', 0),
+                      rate=privmsg.get('per_sec', 0),
+                      rss=result['peak_rss_kb']))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({'revision' : git_revision(), 'time' : time.time(),
+                   'results' : results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Config kept in memory, backed by a shelve db. Changes are written out in
+# one go shortly after they're made, rather than reopening the db for every
+# single setting.
+
+import shelve
+import threading
+
+class ConfigStore:
+    def __init__(self, db, defaults, bootstrap=(), delay=1.0):
+        self.db = db
+        self.defaults = dict(defaults)
+        self.defaults.setdefault('admins', set())
+        self.bootstrap = {x.lower() for x in bootstrap}
+        self.delay = delay
+
+        self.dirty = set()
+        self.timer = None
+
+        # Guards the db file and the dirty set
+        self.lock = threading.Lock()
+
+        self.values = self.read()
+
+    def read(self):
+        with self.lock:
+            s = shelve.open(self.db)
+            try:
+                values = {}
+                for key, default in self.defaults.items():
+                    if key not in s:
+                        s[key] = default
+                    values[key] = s[key]
+            finally:
+                s.close()
+
+        return values
+
+    def reload(self, callback=None):
+        # Read the db in the background; callback is called from that thread
+        # once the new values are in
+        def run():
+            values = self.read()
+            with self.lock:
+                # Anything not flushed yet wins over what's on disk
+                for key in self.dirty:
+                    values[key] = self.values[key]
+                self.values = values
+
+            if callback: callback()
+
+        threading.Thread(target=run, name='socky-config', daemon=True).start()
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.dirty.add(key)
+
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+            if not self.dirty: return
+
+            s = shelve.open(self.db)
+            try:
+                for key in self.dirty:
+                    s[key] = self.values[key]
+            finally:
+                s.close()
+
+            self.dirty.clear()
+
+    @property
+    def admins(self):
+        return self.bootstrap | self.values['admins']
+
+    def add_admin(self, admin):
+        self['admins'] = self.values['admins'] | {admin.lower()}
+
+    def del_admin(self, admin):
+        # Bootstrapped admins can't be removed anyway
+        self['admins'] = self.values['admins'] - {admin.lower()}
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Per-target cooldowns. A heap of expiry times keeps the table from growing
+# forever; entries for targets that have cooled down are dropped lazily.
+
+import heapq
+import time
+
+class Cooldowns:
+    def __init__(self):
+        self.until = {}
+        self.heap = []
+
+    def expire(self, now):
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            when, target = heapq.heappop(heap)
+            # Only drop it if it hasn't been pushed back since
+            if self.until.get(target) == when:
+                del self.until[target]
+
+    def ready(self, target, now=None):
+        if now is None: now = time.time()
+        self.expire(now)
+
+        return target not in self.until
+
+    def remaining(self, target, now=None):
+        if now is None: now = time.time()
+        self.expire(now)
+
+        return max(0, self.until.get(target, now) - now)
+
+    def hold(self, target, seconds, now=None):
+        if now is None: now = time.time()
+
+        when = now + seconds
+        self.until[target] = when
+        heapq.heappush(self.heap, (when, target))
+
+    def release(self, target):
+        # The heap entry goes away on its own
+        self.until.pop(target, None)
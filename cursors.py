@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Server-side search cursors, one per requester. A cursor only remembers the
+# query and which page is next; the hits themselves are fetched when someone
+# actually asks for them, by fetch_page() searching each shard for enough
+# hits to cover that page.
+
+import time
+
+class Cursor:
+    def __init__(self, kind, searchterm, channel=None):
+        self.kind = kind            # 'text' or an event type
+        self.searchterm = searchterm
+        self.channel = channel      # whose scoped shards to look at too
+        self.query = None           # shard -> query, built in the worker
+        self.pagenum = 1
+        self.expires = 0
+
+class CursorStore:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.cursors = {}
+
+    def expire(self, now):
+        for key in [k for k, c in self.cursors.items() if c.expires <= now]:
+            del self.cursors[key]
+
+    def get(self, requester):
+        now = time.time()
+        self.expire(now)
+
+        return self.cursors.get(requester)
+
+    def put(self, requester, cursor):
+        now = time.time()
+        self.expire(now)
+
+        cursor.expires = now + self.ttl
+        self.cursors[requester] = cursor
+
+    def pop(self, requester):
+        return self.cursors.pop(requester, None)
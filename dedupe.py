@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Compact the hive by dropping duplicate triggers. Everything is streamed
+# into a fresh directory minus the duplicates, oldest copy wins, and swapped
+# in like schemaconvert.py does; a running bot picks it up by itself. Near
+# duplicates are only reported, somebody has to decide about those.
+
+from collections import defaultdict
+import argparse
+import os
+import shutil
+import time
+
+from hive import ShardedHive, shard_label
+from journal import Journal
+from matcher import dupe_key
+from schemaconvert import swap_dirs, fresh_dest, check_dest
+from simhash import simhash, hamming, bands, near_distance
+
+def dir_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            total += os.path.getsize(os.path.join(dirpath, name))
+
+    return total
+
+def describe(doc):
+    return ('/me ' if doc.get('useaction') else '') + doc['response']
+
+def group_key(key):
+    # Same as TriggerMatcher.bucket(): any event response can come up for the
+    # event, so those are all one group
+    if key[1] in ('JOIN', 'EXIT'): return (key[1], key[4])
+    return (key[0], key[1], key[4])
+
+def near_pairs(searcher, docnums, distance=near_distance):
+    # Pairs of documents within distance bits. Comparing everything with
+    # everything is no good for the event groups, so only those that agree
+    # on a band get looked at.
+    sigs = {docnum : simhash(searcher.stored_fields(docnum)['response'])
+            for docnum in docnums}
+
+    buckets = defaultdict(list)
+    for docnum, sig in sigs.items():
+        for band in bands(sig, distance + 1):
+            buckets[band].append(docnum)
+
+    pairs = set()
+    for bucket in buckets.values():
+        for i, a in enumerate(bucket):
+            for b in bucket[i + 1:]:
+                if hamming(sigs[a], sigs[b]) <= distance:
+                    pairs.add((a, b))
+
+    return sorted(pairs)
+
+def dedupe(source, dest, chunk=10000, near=False):
+    check_dest(source, dest)
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+
+    oldhive = ShardedHive(source)
+    newhive = ShardedHive(dest)
+
+    # Hashes rather than the keys themselves, or this would hold the whole
+    # hive in memory. Global shards come first, so a scoped trigger that's
+    # also there globally is the one that goes.
+    seen = set()
+    removed = {}
+    kept = 0
+    start = time.time()
+
+    for key in oldhive.keys():
+        label = shard_label(key)
+        removed[key] = 0
+        groups = defaultdict(list)
+
+        with oldhive.get(key).searcher() as searcher:
+            writer = None
+            count = 0
+            for docnum, doc in searcher.reader().iter_docs():
+                dupe = dupe_key(doc)
+                everywhere = dupe[:4] + (None,)
+                if hash(dupe) in seen or hash(everywhere) in seen:
+                    removed[key] += 1
+                    continue
+
+                seen.add(hash(dupe))
+                if near: groups[group_key(dupe)].append(docnum)
+
+                if writer is None:
+                    writer = newhive.get(key, create=True).writer()
+                writer.add_document(**doc)
+                kept += 1
+
+                count += 1
+                if count >= chunk:
+                    writer.commit()
+                    writer = None
+                    count = 0
+
+            if writer is not None:
+                writer.commit()
+
+            print('{}: removed {} duplicates'.format(label, removed[key]))
+
+            for docnums in groups.values():
+                if len(docnums) < 2: continue
+
+                for a, b in near_pairs(searcher, docnums):
+                    a, b = searcher.stored_fields(a), searcher.stored_fields(b)
+                    print('{}: {} looks a lot like {} ({})'.format(
+                        label, describe(a), describe(b), a['trigger']))
+
+    oldhive.close()
+    newhive.close()
+
+    return kept, removed, time.time() - start
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Drop duplicate triggers '
+                                        'from the hive')
+    argparser.add_argument('--index', default='index',
+                           help='index directory to dedupe')
+    argparser.add_argument('--dest', default=None,
+                           help='directory to build the new hive in')
+    argparser.add_argument('--chunk', type=int, default=10000,
+                           help='documents per commit')
+    argparser.add_argument('--near', action='store_true',
+                           help='also report near duplicates')
+    argparser.add_argument('--no-swap', action='store_true',
+                           help='leave the new hive where it is')
+    args = argparser.parse_args()
+
+    # Changes still in the journal would be replayed into the old hive, not
+    # this one
+    journal = Journal(args.index + '.journal')
+    pending = journal.entries()
+    journal.close()
+    if pending:
+        argparser.error('{}.journal is not empty, replay it first'.format(
+            args.index))
+
+    dest = args.dest or fresh_dest(args.index)
+    try:
+        check_dest(args.index, dest)
+    except ValueError as e:
+        argparser.error(str(e))
+
+    before = dir_size(args.index)
+    kept, removed, elapsed = dedupe(args.index, dest, args.chunk, args.near)
+    after = dir_size(dest)
+
+    total = sum(removed.values())
+    print('Removed {} of {} documents ({:.1f}%) in {:.2f} seconds'.format(
+        total, total + kept, 100 * total / (total + kept) if total else 0,
+        elapsed))
+    print('Hive went from {:.1f} MB to {:.1f} MB'.format(before / 1e6,
+                                                         after / 1e6))
+
+    if not args.no_swap:
+        old = swap_dirs(args.index, dest)
+        print('Old hive is at', old)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Fuzzy lookups over the FUZZY trigger vocabulary. Symmetric deletes: every
+# token is filed under each string you can get by deleting up to maxdist
+# characters from it, and a lookup generates the same for the query token, so
+# finding candidates is a handful of dict lookups however big the vocabulary
+# is. Candidates are then checked with a real (bounded) edit distance.
+
+from collections import defaultdict
+
+def deletes(word, maxdist=1):
+    found = frontier = {word}
+    for i in range(maxdist):
+        frontier = {w[:j] + w[j + 1:] for w in frontier for j in range(len(w))}
+        found = found | frontier
+
+    return found
+
+def within_one(a, b):
+    # Levenshtein distance <= 1, without building the whole matrix
+    if a == b: return True
+
+    la, lb = len(a), len(b)
+    if abs(la - lb) > 1: return False
+    if la > lb:
+        a, b = b, a
+        la, lb = lb, la
+
+    i = 0
+    while i < la and a[i] == b[i]:
+        i += 1
+
+    if la == lb:
+        return a[i + 1:] == b[i + 1:]
+    else:
+        return a[i:] == b[i + 1:]
+
+def distance(a, b, maxdist):
+    # Levenshtein distance, or None once it's certain to be over maxdist
+    if a == b: return 0
+    if abs(len(a) - len(b)) > maxdist: return None
+    if maxdist == 1: return 1 if within_one(a, b) else None
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+
+        if min(current) > maxdist: return None
+        previous = current
+
+    return previous[-1] if previous[-1] <= maxdist else None
+
+def similarity(a, b, dist):
+    return 1 - dist / max(len(a), len(b))
+
+class FuzzyIndex:
+    def __init__(self, maxdist=1, prefixlength=1):
+        self.maxdist = maxdist
+        self.prefixlength = prefixlength
+        self.keys = defaultdict(set)    # deletion variant -> tokens
+
+    def add(self, token):
+        for key in deletes(token, self.maxdist):
+            self.keys[key].add(token)
+
+    def remove(self, token):
+        for key in deletes(token, self.maxdist):
+            tokens = self.keys.get(key)
+            if tokens is None: continue
+
+            tokens.discard(token)
+            if not tokens: del self.keys[key]
+
+    def lookup(self, token):
+        # {candidate : similarity} for everything within maxdist. Like
+        # FuzzyTerm, the first prefixlength characters have to match exactly.
+        prefix = token[:self.prefixlength]
+
+        found = {}
+        for key in deletes(token, self.maxdist):
+            for candidate in self.keys.get(key, ()):
+                if candidate in found: continue
+                if candidate[:self.prefixlength] != prefix: continue
+
+                dist = distance(candidate, token, self.maxdist)
+                if dist is not None:
+                    found[candidate] = similarity(candidate, token, dist)
+
+        return found
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Index plumbing shared by the bot and the offline tools.
+
+from collections import deque
+from urllib.parse import quote, unquote
+import os
+import threading
+import time
+
+from whoosh.fields import Schema, TEXT, ID, DATETIME, BOOLEAN
+from whoosh.index import create_in, open_dir, exists_in
+from whoosh.analysis import RegexTokenizer, LowercaseFilter
+from whoosh.analysis import STOP_WORDS
+from whoosh.query import Term, Or, And
+from whoosh.writing import MERGE_SMALL
+from collections import OrderedDict
+
+def make_schema():
+    analyzer = RegexTokenizer(r'[\w:;=]+') | LowercaseFilter()
+    trigtype = TEXT(stored=True, chars=True, vector=True, analyzer=analyzer)
+    return Schema(trigger=trigtype, querytype=ID(stored=True),
+                  useaction=BOOLEAN(stored=True),
+                  response=TEXT(stored=True, chars=True),
+                  who=ID(stored=True), time=DATETIME(stored=True),
+                  channel=ID(stored=True))
+
+# The hive is split into shards, one index each: a shard per querytype for
+# the triggers everyone gets, and one per querytype and channel for those that
+# are scoped to a channel. A shard is keyed by (querytype, channel or None).
+
+def shard_key(fields):
+    return (fields['querytype'], fields.get('channel') or None)
+
+def shard_label(key):
+    # What users see, e.g. literal or literal@#sporks
+    querytype, channel = key
+    if channel is None: return querytype.lower()
+    return querytype.lower() + '@' + channel
+
+def parse_label(label):
+    querytype, sep, channel = label.partition('@')
+    return (querytype.upper(), channel.lower() if sep else None)
+
+def shard_dir(key):
+    # Channels can have just about anything in them
+    querytype, channel = key
+    if channel is None: return querytype.lower()
+    return querytype.lower() + '@' + quote(channel, safe='')
+
+def parse_dir(name):
+    querytype, sep, channel = name.partition('@')
+    return (querytype.upper(), unquote(channel) if sep else None)
+
+class ShardedHive:
+    # A directory of shards. They're opened up front and created on first
+    # write, so a channel nobody has scoped anything to costs nothing.
+
+    def __init__(self, path):
+        # Resolved, so if path is flipped to another hive under us we keep
+        # using this one until we're swapped out
+        self.path = os.path.realpath(path)
+        self.shards = {}
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        elif exists_in(self.path):
+            raise ValueError('{} is an unsharded index, migrate it with '
+                             'shardhive.py first'.format(path))
+
+        for name in sorted(os.listdir(self.path)):
+            if not os.path.isdir(os.path.join(self.path, name)): continue
+            self.shards[parse_dir(name)] = open_dir(os.path.join(self.path,
+                                                                 name))
+
+    def keys(self):
+        with self.lock:
+            return sorted(self.shards, key=lambda k: (k[1] is not None, k))
+
+    def get(self, key, create=False):
+        with self.lock:
+            ix = self.shards.get(key)
+            if ix is None and create:
+                path = os.path.join(self.path, shard_dir(key))
+                if not os.path.exists(path): os.mkdir(path)
+                ix = self.shards[key] = create_in(path, make_schema())
+
+            return ix
+
+    def route(self, querytypes=None, channel=None):
+        # Shards a lookup has to look at: the unscoped ones and the channel's
+        # own, and only for the querytypes asked for
+        return [key for key in self.keys()
+                if (querytypes is None or key[0] in querytypes) and
+                key[1] in (None, channel)]
+
+    def latest_generation(self):
+        # Moves whenever any shard does
+        return tuple((shard_label(key), self.get(key).latest_generation())
+                     for key in self.keys())
+
+    def doc_count(self):
+        return sum(self.get(key).doc_count() for key in self.keys())
+
+    def close(self):
+        for key in self.keys():
+            self.get(key).close()
+
+def open_hive(path='index'):
+    # Initalise the DB or create it
+    return ShardedHive(path)
+
+class SharedSearcher:
+    # One long-lived searcher for all reads. It is only swapped out when the
+    # index generation actually changes: straight away after one of our own
+    # commits, or when another process has touched the index (checked at most
+    # once every check_interval seconds, since that means a directory listing).
+
+    def __init__(self, ix, check_interval=5):
+        self.ix = ix
+        self.check_interval = check_interval
+        self.searcher = ix.searcher()
+        self.lastcheck = time.time()
+
+        self.hits = 0
+        self.refreshes = 0
+
+    def get(self):
+        now = time.time()
+        if now - self.lastcheck >= self.check_interval:
+            self.refresh()
+
+        self.hits += 1
+        return self.searcher
+
+    def refresh(self):
+        self.lastcheck = time.time()
+
+        newsearcher = self.searcher.refresh()
+        if newsearcher is not self.searcher:
+            self.searcher = newsearcher
+            self.refreshes += 1
+
+    def invalidate(self):
+        # Check for a new generation on the next get(). Safe to call from any
+        # thread, unlike refresh().
+        self.lastcheck = 0
+
+    def generation(self):
+        return self.searcher.reader().generation()
+
+    def close(self):
+        self.searcher.close()
+
+class ShardedSearcher:
+    # A SharedSearcher per shard, made when the shard is first asked for.
+    # Like SharedSearcher, only use it from the one thread, bar invalidate().
+
+    def __init__(self, hive, check_interval=5):
+        self.hive = hive
+        self.check_interval = check_interval
+        self.searchers = {}
+
+    def get(self, key):
+        shared = self.searchers.get(key)
+        if shared is None:
+            ix = self.hive.get(key)
+            if ix is None: raise KeyError('No such shard ' + shard_label(key))
+            shared = self.searchers[key] = SharedSearcher(ix,
+                                                          self.check_interval)
+
+        return shared.get()
+
+    def invalidate(self):
+        for shared in list(self.searchers.values()):
+            shared.invalidate()
+
+    def warm(self):
+        # Open everything now rather than on the first search
+        for key in self.hive.keys():
+            self.get(key).reader().doc_count()
+
+    def replace(self, other):
+        # Take over other's hive and searchers, and hand back ours for
+        # closing. Same rules as get(), so searches never see half of each.
+        old = self.searchers
+        self.hive, self.searchers = other.hive, other.searchers
+        return old
+
+    @property
+    def hits(self):
+        return sum(s.hits for s in list(self.searchers.values()))
+
+    @property
+    def refreshes(self):
+        return sum(s.refreshes for s in list(self.searchers.values()))
+
+    def close(self):
+        for shared in self.searchers.values():
+            shared.close()
+
+class QueryExpander:
+    # Builds search queries in two tiers: tokens that are in the index as-is
+    # become plain Terms, and only the ones that miss get expanded to nearby
+    # terms by edit distance. Expansions are cached per shard and token until
+    # that shard's generation changes.
+
+    def __init__(self, maxdist=1, prefixlength=1, stopwords=STOP_WORDS,
+                 cachesize=4096):
+        self.maxdist = maxdist
+        self.prefixlength = prefixlength
+        self.stopwords = frozenset(stopwords)
+        self.cachesize = cachesize
+
+        self.cache = OrderedDict()
+        self.generations = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        # For a whole new hive, where generations could come round again
+        self.cache.clear()
+        self.generations.clear()
+
+    def expand(self, reader, fieldname, token, shard=None):
+        key = (shard, fieldname, token)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+
+        self.misses += 1
+        terms = tuple(reader.terms_within(fieldname, token, self.maxdist,
+                                          prefix=self.prefixlength))
+
+        self.cache[key] = terms
+        if len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+
+        return terms
+
+    def make_query(self, reader, text, fieldname='trigger', shard=None):
+        generation = reader.generation()
+        if generation != self.generations.get(shard):
+            for key in [k for k in self.cache if k[0] == shard]:
+                del self.cache[key]
+            self.generations[shard] = generation
+
+        terms = set()
+        for token in set(text.lower().split()):
+            if (fieldname, token) in reader:
+                terms.add(token)
+            elif token not in self.stopwords:
+                terms.update(self.expand(reader, fieldname, token, shard))
+
+        return Or([Term(fieldname, t) for t in sorted(terms)])
+
+def merge_bounded(maxsegments=8):
+    # Merge policy: the usual small-segment merge, then keep folding the
+    # smallest segments together until there are at most maxsegments left.
+    def policy(writer, segments):
+        from whoosh.reading import SegmentReader
+
+        segments = MERGE_SMALL(writer, segments)
+        if len(segments) <= maxsegments: return segments
+
+        segments = sorted(segments, key=lambda s: s.doc_count_all())
+        count = len(segments) - maxsegments + 1
+        for seg in segments[:count]:
+            reader = SegmentReader(writer.storage, writer.schema, seg)
+            writer.add_reader(reader)
+            reader.close()
+
+        return segments[count:]
+
+    return policy
+
+def find_document(searcher, fields):
+    # Docnum of a live document with exactly these stored fields, or None
+    fields = {k : v for k, v in fields.items() if v is not None}
+
+    tokens = list(searcher.schema['trigger'].process_text(
+        fields.get('trigger', '')))
+    query = And([Term('trigger', t) for t in set(tokens)])
+    if tokens:
+        docnums = searcher.docs_for_query(query)
+    else:
+        docnums = searcher.reader().all_doc_ids()
+
+    for docnum in docnums:
+        if searcher.stored_fields(docnum) == fields:
+            return docnum
+
+    return None
+
+class BatchWriter:
+    # Write-behind queue for the hive. Adds and deletes are queued up and
+    # committed as one batch from a background thread, once batchsize
+    # operations are pending or the oldest one is delay seconds old. A batch
+    # only takes the write lock of the shards it actually touches.
+    #
+    # Callbacks get the exception (or None) as the only argument, once the
+    # change is durable. Without a journal that means once the batch is
+    # committed, and they're called from the writer thread. With one, it's as
+    # soon as the change is in the journal, from the calling thread; a batch
+    # that fails to commit is then retried, backing off, and replayed so the
+    # bits that did make it in aren't done twice. The journal keeps it in
+    # case we never get there.
+    #
+    # on_commit, if set, is called from the writer thread after every batch
+    # that makes it into the index, before any of its callbacks. It gets
+    # {shard : (generation before, generation after)} for each shard we
+    # committed to, so it can tell our commits from anybody else's.
+
+    def __init__(self, hive, batchsize=100, delay=1.0, maxsegments=8,
+                 journal=None, history=10000):
+        self.hive = hive
+        self.batchsize = batchsize
+        self.delay = delay
+        self.mergetype = merge_bounded(maxsegments)
+        self.journal = journal
+
+        # The last few changes that made it in, for swap()
+        self.history = deque(maxlen=history)
+
+        self.pending = []
+        self.oldest = None
+        self.closing = False
+        self.committing = False
+        self.cond = threading.Condition()
+
+        # A batch that failed to commit, and when to have another go
+        self.failed = []
+        self.retry_at = 0
+        self.backoff = 0
+        self.maxbackoff = 60
+
+        self.commits = 0
+        self.committed = 0
+
+        self.on_commit = None
+
+        self.thread = threading.Thread(target=self.run, name='socky-writer',
+                                       daemon=True)
+        self.thread.start()
+
+    def queue(self, op, args, callback=None):
+        with self.cond:
+            if self.closing:
+                raise RuntimeError('Writer is closed')
+
+            seq = self.journal.append(op, args) if self.journal else None
+
+            if not self.pending: self.oldest = time.time()
+            self.pending.append((op, args, callback, seq))
+            self.cond.notify_all()
+
+        if self.journal and callback:
+            callback(None)
+
+    def add_document(self, fields, callback=None):
+        self.queue('add_document', fields, callback)
+
+    def delete_document(self, docnum, callback, fields):
+        # fields is what we think is stored there. It says which shard docnum
+        # is in, and lets a replay tell whether it's still the same document.
+        self.queue('delete_document', (docnum, fields), callback)
+
+    def delete_by_term(self, fieldname, text, callback=None):
+        self.queue('delete_by_term', (fieldname, text), callback)
+
+    def flush(self):
+        with self.cond:
+            self.oldest = 0
+            self.retry_at = 0
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+
+        self.thread.join()
+        if self.journal: self.journal.close()
+
+    def take(self):
+        # (batch, retrying), or None once we're closed
+        with self.cond:
+            while True:
+                if self.failed:
+                    wait = self.retry_at - time.time()
+                    if wait <= 0 or self.closing: break
+                elif self.pending:
+                    if len(self.pending) >= self.batchsize or self.closing:
+                        break
+
+                    wait = self.oldest + self.delay - time.time()
+                    if wait <= 0: break
+                elif self.closing:
+                    return None
+                else:
+                    wait = None
+
+                self.cond.wait(wait)
+
+            retrying = bool(self.failed)
+            batch = self.failed + self.pending
+            self.failed, self.pending = [], []
+            self.committing = True
+            return batch, retrying
+
+    def idle(self):
+        # Nothing queued and nothing on its way into the index
+        with self.cond:
+            return not self.pending and not self.committing and not self.failed
+
+    def run(self):
+        while True:
+            taken = self.take()
+            if taken is None: return
+            batch, retrying = taken
+
+            error = None
+            try:
+                moved = self.commit(batch, retrying)
+            except Exception as e:
+                error = e
+
+            if not error:
+                self.history.extend((op, args) for op, args, callback, seq
+                                    in batch)
+
+                if self.on_commit:
+                    try:
+                        self.on_commit(moved)
+                    except Exception as e:
+                        print('Commit hook failed:', e)
+
+            with self.cond:
+                if self.journal and error and not self.closing:
+                    # Part of it may be in; the retry replays, so that's fine
+                    self.backoff = min(max(self.backoff * 2, self.delay),
+                                       self.maxbackoff)
+                    self.retry_at = time.time() + self.backoff
+                    self.failed = batch
+                    print('Commit failed, retrying in {:.1f}s: {}'.format(
+                        self.backoff, error))
+                elif not error:
+                    self.backoff = 0
+
+            if self.journal:
+                if not error:
+                    self.journal.discard(seq for op, args, callback, seq in batch)
+                elif self.closing:
+                    print('Commit failed, leaving it in the journal:', error)
+
+            with self.cond:
+                self.committing = False
+                self.cond.notify_all()
+
+            if self.journal: continue
+
+            for op, args, callback, seq in batch:
+                if not callback: continue
+
+                try:
+                    callback(error)
+                except Exception as e:
+                    print('Writer callback failed:', e)
+
+    def route(self, op, args, hive=None):
+        # Which shards an operation touches
+        hive = hive or self.hive
+        if op == 'add_document':
+            return [shard_key(args)]
+        elif op == 'delete_document':
+            return [shard_key(args[1])]
+        elif op == 'delete_by_term':
+            keys = []
+            for key in hive.keys():
+                with hive.get(key).reader() as reader:
+                    if tuple(args) in reader: keys.append(key)
+            return keys
+
+        return []
+
+    def group(self, ops, hive=None):
+        # [(shard, [(op, args), ...]), ...], in the order they were queued
+        groups = OrderedDict()
+        for op, args in ops:
+            for key in self.route(op, args, hive):
+                groups.setdefault(key, []).append((op, args))
+
+        return groups.items()
+
+    def apply(self, writer, op, args, searcher=None):
+        # With a searcher, we're replaying and have to be idempotent: the
+        # change may or may not have made it into the index already
+        if op == 'add_document':
+            if searcher and find_document(searcher, args) is not None:
+                return
+            writer.add_document(**args)
+        elif op == 'delete_document':
+            docnum, fields = args
+            if searcher and fields is not None:
+                reader = searcher.reader()
+                if (docnum >= reader.doc_count_all() or reader.is_deleted(docnum)
+                        or searcher.stored_fields(docnum) != fields):
+                    docnum = find_document(searcher, fields)
+                    if docnum is None: return
+            writer.delete_document(docnum)
+        elif op == 'delete_by_term':
+            writer.delete_by_term(*args)
+
+    def commit(self, batch, replaying=False):
+        # One commit per shard. If a later one fails the earlier ones stay
+        # committed, which is fine: replaying them is a no-op.
+        ops = [(op, args) for op, args, callback, seq in batch]
+        moved = {}
+        if replaying:
+            moved = self.replay_into(self.hive, ops)
+            ops = []
+
+        for key, shardops in self.group(ops):
+            writer = self.hive.get(key, create=True).writer(timeout=30)
+            try:
+                for op, args in shardops:
+                    self.apply(writer, op, args)
+            except:
+                writer.cancel()
+                raise
+
+            writer.commit(mergetype=self.mergetype)
+            moved[key] = (writer.generation - 1, writer.generation)
+
+        self.commits += 1
+        self.committed += len(batch)
+
+        return moved
+
+    def replay(self):
+        # Apply whatever the journal holds that the hive might not. Call this
+        # before anything else touches the hive.
+        if not self.journal: return 0
+
+        entries = self.journal.entries()
+        if not entries: return 0
+
+        self.replay_into(self.hive, [(op, args) for seq, op, args in entries])
+        self.journal.discard(seq for seq, op, args in entries)
+
+        return len(entries)
+
+    def replay_into(self, hive, ops):
+        # Returns the same as commit()
+        moved = {}
+        for key, shardops in self.group(ops, hive):
+            ix = hive.get(key, create=True)
+            writer = ix.writer(timeout=30)
+            try:
+                with ix.searcher() as searcher:
+                    for op, args in shardops:
+                        self.apply(writer, op, args, searcher)
+            except:
+                writer.cancel()
+                raise
+
+            writer.commit(mergetype=self.mergetype)
+            moved[key] = (writer.generation - 1, writer.generation)
+
+        return moved
+
+    def swap(self, hive):
+        # Point at another hive, once everything queued has gone into this
+        # one. It was most likely built from a copy of this one a while ago,
+        # so whatever we've committed lately is replayed into it first.
+        self.flush()
+        with self.cond:
+            while self.pending or self.committing:
+                self.cond.wait()
+
+            # The writer thread can't take anything while we hold this. A
+            # batch still waiting on a retry goes into the new hive instead.
+            failed, self.failed = self.failed, []
+            failedops = [(op, args) for op, args, callback, seq in failed]
+            ops = list(self.history) + failedops
+            try:
+                self.replay_into(hive, ops)
+            except:
+                self.failed = failed
+                raise
+
+            self.history.extend(failedops)
+            self.hive = hive
+
+        if self.journal and failed:
+            self.journal.discard(seq for op, args, callback, seq in failed)
+
+        return len(ops)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Bulk import/export of the hive as JSON lines, one trigger per line.
+
+from datetime import datetime
+import argparse
+import json
+import sys
+import time
+
+from hive import open_hive, shard_key
+from matcher import dupe_key
+
+fields = ('trigger', 'querytype', 'response', 'useaction', 'who', 'time',
+          'channel')
+
+def export_hive(hive, out):
+    count = 0
+    for key in hive.keys():
+        with hive.get(key).searcher() as searcher:
+            for doc in searcher.documents():
+                record = {k : doc.get(k) for k in fields}
+                if isinstance(record['time'], datetime):
+                    record['time'] = record['time'].isoformat()
+
+                out.write(json.dumps(record, ensure_ascii=False))
+                out.write('\n')
+                count += 1
+
+    return count
+
+def read_records(infile):
+    for lineno, line in enumerate(infile, 1):
+        line = line.strip()
+        if not line: continue
+
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            print('Skipping line', lineno, str(e), file=sys.stderr)
+            continue
+
+        doc = {k : record.get(k) for k in fields}
+        if not doc['trigger'] or not doc['querytype'] or not doc['response']:
+            print('Skipping line', lineno, 'missing fields', file=sys.stderr)
+            continue
+
+        doc['useaction'] = bool(doc['useaction'])
+        if doc['channel']:
+            # Lowercase like scope() and parse_label(), or it'd never match
+            doc['channel'] = doc['channel'].lower()
+        if isinstance(doc['time'], str):
+            doc['time'] = datetime.fromisoformat(doc['time'])
+
+        # Whoosh doesn't like None for a field
+        yield {k : v for k, v in doc.items() if v is not None}
+
+def import_hive(hive, infile, batch=10000):
+    seen = set()
+    for key in hive.keys():
+        with hive.get(key).searcher() as searcher:
+            seen.update(dupe_key(doc) for doc in searcher.documents())
+
+    added = skipped = 0
+    start = time.time()
+
+    # A writer per shard, all committed together every batch documents
+    writers = {}
+    pending = 0
+    for doc in read_records(infile):
+        key = dupe_key(doc)
+        if key in seen:
+            skipped += 1
+            continue
+
+        seen.add(key)
+        shard = shard_key(doc)
+        if shard not in writers:
+            writers[shard] = hive.get(shard, create=True).writer()
+        writers[shard].add_document(**doc)
+        pending += 1
+
+        if pending >= batch:
+            for writer in writers.values():
+                writer.commit()
+            writers = {}
+            added += pending
+            pending = 0
+
+            elapsed = time.time() - start
+            print('{} documents, {:.0f} docs/sec'.format(added, added / elapsed),
+                  file=sys.stderr)
+
+    for writer in writers.values():
+        writer.commit()
+    added += pending
+
+    return added, skipped, time.time() - start
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Import or export the hive '
+                                        'as JSON lines')
+    argparser.add_argument('--index', default='index', help='index directory')
+    subparsers = argparser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    exportparser = subparsers.add_parser('export', help='dump the hive')
+    exportparser.add_argument('file', nargs='?', default='-',
+                              help='output file (default stdout)')
+
+    importparser = subparsers.add_parser('import', help='load into the hive')
+    importparser.add_argument('file', nargs='?', default='-',
+                              help='input file (default stdin)')
+    importparser.add_argument('--batch', type=int, default=10000,
+                              help='documents per commit')
+
+    args = argparser.parse_args()
+    hive = open_hive(args.index)
+
+    if args.command == 'export':
+        if args.file == '-':
+            count = export_hive(hive, sys.stdout)
+        else:
+            with open(args.file, 'w', encoding='utf-8') as out:
+                count = export_hive(hive, out)
+
+        print('Exported', count, 'documents', file=sys.stderr)
+    else:
+        if args.file == '-':
+            result = import_hive(hive, sys.stdin, args.batch)
+        else:
+            with open(args.file, encoding='utf-8') as infile:
+                result = import_hive(hive, infile, args.batch)
+
+        added, skipped, elapsed = result
+        print('Imported {} documents ({} duplicates skipped) in {:.2f} seconds, '
+              '{:.0f} docs/sec'.format(added, skipped, elapsed,
+                                       added / elapsed if elapsed else 0),
+              file=sys.stderr)
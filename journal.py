@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Append-only journal of trigger mutations. Every change is fsync'd here
+# before it's acknowledged; the index catches up in batches, and whatever it
+# hadn't caught up with when we died gets replayed on startup.
+
+from datetime import datetime
+import json
+import os
+import threading
+
+def encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__' : value.isoformat()}
+    raise TypeError('Cannot journal {!r}'.format(value))
+
+def decode(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+        entries = self.entries()
+        self.seq = entries[-1][0] if entries else 0
+
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def entries(self):
+        # [(seq, op, args), ...] in order. A torn last line (we died while
+        # writing it) was never acknowledged, so it's just skipped.
+        if not os.path.exists(self.path): return []
+
+        entries = []
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line, object_hook=decode)
+                except ValueError:
+                    continue
+
+                entries.append((entry['seq'], entry['op'], entry['args']))
+
+        return entries
+
+    def append(self, op, args):
+        with self.lock:
+            self.seq += 1
+            entry = {'seq' : self.seq, 'op' : op, 'args' : args}
+            self.file.write(json.dumps(entry, default=encode) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            return self.seq
+
+    def discard(self, seqs):
+        # Drop entries that are safely in the index. Rewritten to the side and
+        # renamed over, so a crash here leaves either the old or new journal.
+        seqs = set(seqs)
+        with self.lock:
+            keep = [e for e in self.entries() if e[0] not in seqs]
+
+            tmppath = self.path + '.tmp'
+            with open(tmppath, 'w', encoding='utf-8') as f:
+                for seq, op, args in keep:
+                    entry = {'seq' : seq, 'op' : op, 'args' : args}
+                    f.write(json.dumps(entry, default=encode) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.file.close()
+            os.replace(tmppath, self.path)
+            self.file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
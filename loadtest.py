@@ -0,0 +1,642 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# End-to-end load harness. Runs a stand-in IRC server on localhost that
+# speaks just enough of the protocol for PyIRC (registration, SASL, JOIN,
+# WHO/WHOX, extended-join and account-notify for the admin checks), points the
+# bot at it, and throws chatter, join/part storms and netsplits at it. Every
+# line the bot sends is recorded with a timestamp, so we get response latency,
+# flood behaviour and where it falls over, without bothering a real network.
+
+from collections import namedtuple
+import argparse
+import base64
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench import parse_line, build_hive, make_words, percentile
+
+servername = 'load.test'
+caps = ('sasl', 'account-notify', 'extended-join', 'multi-prefix')
+
+# Bootstrapped admin in socky.py, so probes work on a fresh config
+admin_account = 'Elizacat'
+
+# Seconds between probes. The bot paces itself to a line every 2 seconds once
+# its burst is gone (SendQueue) and never drops admin lines, so anything
+# quicker just measures its own backlog.
+probe_every = 10.0
+
+User = namedtuple('User', 'nick account')
+
+class Session:
+    # The bot's side of things: one connection, one nick
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('r', encoding='utf-8', errors='replace')
+        self.lock = threading.Lock()
+
+        self.nick = None
+        self.user = None
+        self.account = None
+        self.registered = False
+        self.negotiating = False
+        self.caps = set()
+        self.channels = set()
+
+    @property
+    def hostmask(self):
+        return '{}!{}@bot.{}'.format(self.nick, self.user or 'socky',
+                                     servername)
+
+    def send(self, line):
+        data = (line + '\r\n').encode('utf-8')
+        with self.lock:
+            self.sock.sendall(data)
+
+class FakeServer:
+    def __init__(self, host='127.0.0.1', port=6667):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+        self.session = None
+        self.joined = threading.Event()
+
+        # channel -> {nick : User}, everyone but the bot
+        self.members = {}
+
+        # (time, command, params) for everything the bot says, and the hooks
+        # that want to know about it as it happens
+        self.outbound = []
+        self.watchers = []
+
+    def accept(self):
+        sock, addr = self.listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.session = Session(sock)
+
+        thread = threading.Thread(target=self.read, args=(self.session,),
+                                  name='loadtest-server', daemon=True)
+        thread.start()
+        return self.session
+
+    def numeric(self, session, num, *params):
+        self.reply(session, num, session.nick or '*', *params)
+
+    def reply(self, session, command, *params):
+        params = list(params)
+        if params and (' ' in params[-1] or params[-1].startswith(':') or
+                       not params[-1]):
+            params[-1] = ':' + params[-1]
+        session.send(' '.join([':' + servername, command] + params))
+
+    def read(self, session):
+        for text in session.file:
+            text = text.rstrip('\r\n')
+            if not text: continue
+
+            line = parse_line(text)
+            handler = getattr(self, 'on_' + line.command.lower(), None)
+            if handler:
+                try:
+                    handler(session, line.params)
+                except (IndexError, ValueError):
+                    self.numeric(session, '461', line.command,
+                                 'Not enough parameters')
+
+        session.registered = False
+
+    def try_register(self, session):
+        if session.registered or session.negotiating: return
+        if not (session.nick and session.user): return
+
+        session.registered = True
+        self.numeric(session, '001', 'Welcome to the load test network ' +
+                     session.hostmask)
+        self.numeric(session, '002', 'Your host is ' + servername)
+        self.numeric(session, '003', 'This server was created just now')
+        self.numeric(session, '004', servername, 'loadtest-1', 'iowZ',
+                     'biklmnopstv')
+        self.numeric(session, '005', 'CHANTYPES=#', 'PREFIX=(ov)@+',
+                     'CHANMODES=b,k,l,imnpst', 'NETWORK=LoadTest',
+                     'CASEMAPPING=rfc1459', 'NICKLEN=30', 'WHOX',
+                     'are supported by this server')
+        self.numeric(session, '422', 'MOTD File is missing')
+
+    def on_cap(self, session, params):
+        sub = params[0].upper()
+        if sub == 'LS':
+            session.negotiating = True
+            self.reply(session, 'CAP', '*', 'LS', ' '.join(caps))
+        elif sub == 'REQ':
+            wanted = params[-1].split()
+            if all(c.lstrip('-') in caps for c in wanted):
+                session.caps.update(c for c in wanted if not c.startswith('-'))
+                self.reply(session, 'CAP', '*', 'ACK', ' '.join(wanted))
+            else:
+                self.reply(session, 'CAP', '*', 'NAK', ' '.join(wanted))
+        elif sub == 'END':
+            session.negotiating = False
+            self.try_register(session)
+
+    def on_authenticate(self, session, params):
+        if params[0].upper() == 'PLAIN':
+            session.send('AUTHENTICATE +')
+            return
+
+        try:
+            authzid, authcid, password = base64.b64decode(
+                params[0]).decode('utf-8').split('\0')
+        except ValueError:
+            self.numeric(session, '904', 'SASL authentication failed')
+            return
+
+        session.account = authcid or authzid
+        self.numeric(session, '900', session.hostmask, session.account,
+                     'You are now logged in as ' + session.account)
+        self.numeric(session, '903', 'SASL authentication successful')
+
+    def on_nick(self, session, params):
+        old = session.hostmask
+        session.nick = params[0]
+        if session.registered:
+            session.send(':{} NICK {}'.format(old, session.nick))
+        else:
+            self.try_register(session)
+
+    def on_user(self, session, params):
+        session.user = params[0]
+        self.try_register(session)
+
+    def on_ping(self, session, params):
+        self.reply(session, 'PONG', servername, params[-1])
+
+    def on_join(self, session, params):
+        for channel in params[0].split(','):
+            self.join_bot(session, channel.lower())
+
+    def join_bot(self, session, channel):
+        if channel in session.channels: return
+        session.channels.add(channel)
+        members = self.members.setdefault(channel, {})
+
+        if 'extended-join' in session.caps:
+            session.send(':{} JOIN {} {} :Socky'.format(
+                session.hostmask, channel, session.account or '*'))
+        else:
+            session.send(':{} JOIN {}'.format(session.hostmask, channel))
+
+        names = [session.nick] + list(members)
+        for i in range(0, len(names), 40):
+            self.numeric(session, '353', '=', channel,
+                         ' '.join(names[i:i + 40]))
+        self.numeric(session, '366', channel, 'End of /NAMES list.')
+
+        self.joined.set()
+
+    def on_part(self, session, params):
+        for channel in params[0].split(','):
+            session.channels.discard(channel.lower())
+            session.send(':{} PART {}'.format(session.hostmask, channel))
+
+    def on_mode(self, session, params):
+        if params[0].startswith('#'):
+            self.numeric(session, '324', params[0], '+nt')
+
+    def on_who(self, session, params):
+        mask = params[0].lower()
+        whox = params[1] if len(params) > 1 and params[1].startswith('%') else None
+
+        users = list(self.members.get(mask, {}).values())
+        for user in users:
+            if whox:
+                self.who_reply(session, mask, user, whox)
+            else:
+                self.numeric(session, '352', mask, user.nick, servername,
+                             servername, user.nick, 'H', '0 ' + user.nick)
+        self.numeric(session, '315', params[0], 'End of /WHO list.')
+
+    def who_reply(self, session, channel, user, whox):
+        fields, _, token = whox[1:].partition(',')
+        values = {
+            't' : token or '0', 'c' : channel, 'u' : user.nick,
+            'i' : '127.0.0.1', 'h' : servername, 's' : servername,
+            'n' : user.nick, 'f' : 'H', 'd' : '0', 'l' : '0',
+            'a' : user.account or '0', 'o' : 'n/a', 'r' : user.nick,
+        }
+        # Replies always come in this order, whatever order they were asked
+        reply = [values[f] for f in 'tcuihsnfdlaor' if f in fields]
+        self.numeric(session, '354', *reply)
+
+    def on_whois(self, session, params):
+        nick = params[-1]
+        for members in self.members.values():
+            user = members.get(nick)
+            if user: break
+        else:
+            self.numeric(session, '401', nick, 'No such nick/channel')
+            return
+
+        self.numeric(session, '311', nick, nick, servername, '*', nick)
+        if user.account:
+            self.numeric(session, '330', nick, user.account, 'is logged in as')
+        self.numeric(session, '318', nick, 'End of /WHOIS list.')
+
+    def on_privmsg(self, session, params):
+        self.record('PRIVMSG', params)
+
+    def on_notice(self, session, params):
+        self.record('NOTICE', params)
+
+    def on_quit(self, session, params):
+        self.record('QUIT', params)
+        session.send('ERROR :Closing link')
+        session.sock.close()
+
+    def record(self, command, params):
+        now = time.time()
+        self.outbound.append((now, command, params))
+        for watcher in self.watchers:
+            watcher(now, command, params)
+
+    # What the simulated users do
+
+    def from_user(self, user):
+        return ':{0}!{0}@users.{1}'.format(user.nick, servername)
+
+    def user_join(self, user, channel):
+        members = self.members.setdefault(channel, {})
+        if user.nick in members: return
+        members[user.nick] = user
+
+        session = self.session
+        if not session or channel not in session.channels: return
+
+        if 'extended-join' in session.caps:
+            session.send('{} JOIN {} {} :{}'.format(
+                self.from_user(user), channel, user.account or '*', user.nick))
+        else:
+            session.send('{} JOIN {}'.format(self.from_user(user), channel))
+            if user.account and 'account-notify' in session.caps:
+                session.send('{} ACCOUNT {}'.format(self.from_user(user),
+                                                    user.account))
+
+    def user_part(self, user, channel):
+        members = self.members.get(channel, {})
+        if members.pop(user.nick, None) and channel in self.session.channels:
+            self.session.send('{} PART {} :bye'.format(self.from_user(user),
+                                                        channel))
+
+    def user_quit(self, user, message):
+        seen = False
+        for members in self.members.values():
+            if members.pop(user.nick, None): seen = True
+
+        if seen:
+            self.session.send('{} QUIT :{}'.format(self.from_user(user),
+                                                    message))
+
+    def user_say(self, user, channel, text):
+        self.session.send('{} PRIVMSG {} :{}'.format(self.from_user(user),
+                                                     channel, text))
+
+    def close(self):
+        self.listener.close()
+        if self.session: self.session.sock.close()
+
+class LoadTest:
+    def __init__(self, server, channels, users, words, seed=0):
+        self.server = server
+        self.rng = random.Random(seed)
+        self.words = words
+
+        self.channels = ['#load{}'.format(i) for i in range(1, channels + 1)]
+        self.probechannel = '#loadprobe'
+
+        # Half the users are logged in, like on a real network
+        self.users = [User('user{}'.format(i),
+                           'acct{}'.format(i) if i % 2 else None)
+                      for i in range(users)]
+        self.admin = User('loadadmin', admin_account)
+        self.homes = {user.nick : self.rng.sample(self.channels,
+                                                  min(len(self.channels),
+                                                      self.rng.randint(1, 3)))
+                      for user in self.users}
+
+        # When the last chatter went to each channel, and probes waiting on
+        # an answer
+        self.lastsaid = {}
+        self.probes = []
+        self.latencies = []
+        self.delays = []
+        self.responses = 0
+        self.lock = threading.Lock()
+
+        server.watchers.append(self.seen)
+
+    def setup(self):
+        # Everyone takes their seats before the bot is dragged in, so the
+        # NAMES/WHO burst is realistic
+        for user in self.users:
+            for channel in self.homes[user.nick]:
+                self.server.user_join(user, channel)
+        self.server.user_join(self.admin, self.probechannel)
+
+        session = self.server.session
+        for channel in self.channels + [self.probechannel]:
+            self.server.join_bot(session, channel)
+
+    def seen(self, now, command, params):
+        if command != 'PRIVMSG' or len(params) < 2: return
+
+        target, text = params[0].lower(), params[-1]
+        with self.lock:
+            if target == self.probechannel:
+                if self.probes and text.startswith('Seen '):
+                    self.latencies.append(now - self.probes.pop(0))
+            elif target in self.lastsaid:
+                self.responses += 1
+                self.delays.append(now - self.lastsaid[target])
+
+    def command(self, text):
+        # Said by the admin, at the bot
+        nick = self.server.session.nick
+        self.server.user_say(self.admin, self.probechannel,
+                             '{}: {}'.format(nick, text))
+
+    def probe(self):
+        with self.lock:
+            self.probes.append(time.time())
+        self.command('[stats] $ []')
+
+    def chatter(self):
+        channel = self.rng.choice(self.channels)
+        members = list(self.server.members.get(channel, {}).values())
+        if not members: return False
+
+        user = self.rng.choice(members)
+        length = self.rng.randint(1, 12)
+        text = ' '.join(self.words[int(self.rng.paretovariate(1.2)) %
+                                   len(self.words)] for _ in range(length))
+
+        with self.lock:
+            self.lastsaid[channel] = time.time()
+        self.server.user_say(user, channel, text)
+        return True
+
+    def storm(self, size):
+        # A pile of people join a channel and leave straight away again
+        channel = self.rng.choice(self.channels)
+        users = self.rng.sample(self.users, min(size, len(self.users)))
+        for user in users:
+            self.server.user_join(user, channel)
+        for user in users:
+            if channel not in self.homes[user.nick]:
+                self.server.user_part(user, channel)
+
+    def split(self, fraction):
+        users = self.rng.sample(self.users, int(len(self.users) * fraction))
+        for user in users:
+            self.server.user_quit(user, '*.net *.split')
+        return users
+
+    def heal(self, users):
+        for user in users:
+            for channel in self.homes[user.nick]:
+                self.server.user_join(user, channel)
+
+    def run_step(self, rate, duration, storm_every=0, storm_size=50,
+                 split_every=0, split_fraction=0.3, split_heal=5,
+                 probe_every=probe_every):
+        # rate is messages per second per channel
+        total = rate * len(self.channels)
+        interval = 1 / total if total else None
+
+        start = now = time.time()
+        end = start + duration
+        nextmsg = start
+        nextprobe = start
+        nextstorm = start + storm_every if storm_every else None
+        nextsplit = start + split_every if split_every else None
+        healing = []        # (when, users)
+
+        sent = probes = storms = splits = 0
+        firstline = len(self.server.outbound)
+        with self.lock:
+            firstlatency = len(self.latencies)
+            firstdelay = len(self.delays)
+            firstresponse = self.responses
+
+        while now < end:
+            if interval and now >= nextmsg:
+                if self.chatter(): sent += 1
+                nextmsg += interval
+
+            if now >= nextprobe:
+                # One at a time, or they queue up behind each other
+                with self.lock:
+                    waiting = bool(self.probes)
+                if not waiting:
+                    self.probe()
+                    probes += 1
+                nextprobe += probe_every
+
+            if nextstorm and now >= nextstorm:
+                self.storm(storm_size)
+                storms += 1
+                nextstorm += storm_every
+
+            if nextsplit and now >= nextsplit:
+                healing.append((now + split_heal, self.split(split_fraction)))
+                splits += 1
+                nextsplit += split_every
+
+            while healing and healing[0][0] <= now:
+                self.heal(healing.pop(0)[1])
+
+            # Only sleep if we're keeping up; falling behind is the point
+            due = min(nextmsg if interval else end, nextprobe,
+                      nextstorm or end, nextsplit or end,
+                      healing[0][0] if healing else end)
+            now = time.time()
+            if due > now: time.sleep(min(due - now, 0.05))
+            now = time.time()
+
+        for when, users in healing:
+            self.heal(users)
+
+        elapsed = time.time() - start
+        lines = [t for t, command, params in self.server.outbound[firstline:]]
+        with self.lock:
+            latencies = self.latencies[firstlatency:]
+            delays = self.delays[firstdelay:]
+            responses = self.responses - firstresponse
+            unanswered = len(self.probes)
+
+            # One still waiting has taken at least this long
+            latencies += [time.time() - when for when in self.probes]
+
+        return {
+            'target_rate' : total,
+            'achieved_rate' : sent / elapsed if elapsed else 0,
+            'messages' : sent,
+            'storms' : storms,
+            'netsplits' : splits,
+            'responses' : responses,
+            'bot_lines' : len(lines),
+            'bot_lines_per_sec' : len(lines) / elapsed if elapsed else 0,
+            'max_lines_1s' : max_window(lines, 1),
+            'max_lines_10s' : max_window(lines, 10),
+            'probes' : probes,
+            'probes_unanswered' : unanswered,
+            'probe_latency' : summarise(latencies),
+            'response_delay' : summarise(delays),
+        }
+
+def max_window(times, width):
+    # Most lines sent in any width seconds
+    best = start = 0
+    for end in range(len(times)):
+        while times[end] - times[start] > width:
+            start += 1
+        best = max(best, end - start + 1)
+
+    return best
+
+def summarise(values):
+    return {
+        'count' : len(values),
+        'p50_ms' : percentile(values, 50) * 1000,
+        'p99_ms' : percentile(values, 99) * 1000,
+        'max_ms' : max(values) * 1000 if values else 0,
+    }
+
+def spawn_bot(port, index, workdir):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, os.path.join(here, 'socky.py'),
+                             '--server', '127.0.0.1:{}'.format(port),
+                             '--index', index], cwd=workdir)
+
+def main():
+    argparser = argparse.ArgumentParser(description='Load test the bot '
+                                        'against a local fake IRC server')
+    argparser.add_argument('--port', type=int, default=6667,
+                           help='port to listen on (0 picks one)')
+    argparser.add_argument('--spawn', action='store_true',
+                           help='start socky.py ourselves, against a '
+                           'synthetic hive')
+    argparser.add_argument('--hive-size', type=int, default=10000,
+                           help='triggers in the synthetic hive')
+    argparser.add_argument('--workdir', default=None,
+                           help='where the synthetic hive and bot config go')
+    argparser.add_argument('--channels', type=int, default=10)
+    argparser.add_argument('--users', type=int, default=200)
+    argparser.add_argument('--rate', type=float, default=1,
+                           help='messages per second per channel')
+    argparser.add_argument('--ramp', default=None,
+                           help='comma separated rates to step through '
+                           'instead, e.g. 1,5,10,50')
+    argparser.add_argument('--duration', type=float, default=30,
+                           help='seconds per step')
+    argparser.add_argument('--storm-every', type=float, default=0,
+                           help='seconds between join/part storms, 0 for none')
+    argparser.add_argument('--storm-size', type=int, default=50)
+    argparser.add_argument('--split-every', type=float, default=0,
+                           help='seconds between netsplits, 0 for none')
+    argparser.add_argument('--split-fraction', type=float, default=0.3,
+                           help='share of users that go with a split')
+    argparser.add_argument('--split-heal', type=float, default=5,
+                           help='seconds until split users come back')
+    argparser.add_argument('--probe-every', type=float, default=probe_every,
+                           help='seconds between [stats] round trips')
+    argparser.add_argument('--interval', type=int, default=0,
+                           help='setinterval to give the bot first, so '
+                           'cooldowns don\'t hide everything')
+    argparser.add_argument('--saturation-ms', type=float, default=2000,
+                           help='probe p99 beyond which a step counts as '
+                           'saturated')
+    argparser.add_argument('--output', default='loadtest.json')
+    argparser.add_argument('--log', default=None,
+                           help='write every line the bot sent here')
+    args = argparser.parse_args()
+
+    rates = [float(r) for r in args.ramp.split(',')] if args.ramp else [args.rate]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='socky-load-')
+    index = os.path.join(workdir, 'index')
+
+    # Chatter is made from the same words as the hive, so it hits triggers
+    if args.spawn and not os.path.exists(index):
+        print('Building a hive of', args.hive_size, 'triggers in', index)
+        words = build_hive(index, args.hive_size)
+    else:
+        words = make_words(random.Random(0), max(args.hive_size // 4, 500))
+
+    server = FakeServer(port=args.port)
+    print('Listening on port', server.port)
+
+    bot = spawn_bot(server.port, index, workdir) if args.spawn else None
+    try:
+        server.accept()
+        if not server.joined.wait(60):
+            sys.exit('Bot never joined a channel')
+
+        test = LoadTest(server, args.channels, args.users, words)
+        test.setup()
+        test.command('[setinterval] $ [{}]'.format(args.interval))
+        time.sleep(1)
+
+        steps = []
+        for rate in rates:
+            print('Step: {} msgs/sec per channel for {} seconds'.format(
+                rate, args.duration))
+            result = test.run_step(rate, args.duration, args.storm_every,
+                                   args.storm_size, args.split_every,
+                                   args.split_fraction, args.split_heal,
+                                   args.probe_every)
+            result['saturated'] = (
+                result['probe_latency']['p99_ms'] > args.saturation_ms or
+                result['achieved_rate'] < 0.9 * result['target_rate'])
+            steps.append(result)
+
+            print('  in {achieved_rate:.0f}/{target_rate:.0f} msg/s, '
+                  'out {bot_lines_per_sec:.2f} lines/s (max {max_lines_10s} in '
+                  '10s), probe p50 {p50:.0f}ms p99 {p99:.0f}ms{sat}'.format(
+                      p50=result['probe_latency']['p50_ms'],
+                      p99=result['probe_latency']['p99_ms'],
+                      sat=', SATURATED' if result['saturated'] else '',
+                      **result))
+    finally:
+        if bot:
+            bot.terminate()
+            bot.wait()
+        server.close()
+
+    report = {
+        'when' : time.time(),
+        'channels' : args.channels,
+        'users' : args.users,
+        'hive_size' : args.hive_size,
+        'steps' : steps,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote', args.output)
+
+    if args.log:
+        with open(args.log, 'w', encoding='utf-8') as f:
+            for when, command, params in server.outbound:
+                f.write('{:.6f}\t{} {}\n'.format(when, command, ' '.join(params)))
+
+if __name__ == '__main__':
+    main()
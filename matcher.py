@@ -0,0 +1,623 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# In-memory trigger matcher. Whoosh is still the store of record; this is
+# just a derived view of it so handle_privmsg doesn't have to go to the index
+# for every line of chatter.
+
+from collections import namedtuple, defaultdict, deque, OrderedDict
+import os
+import pickle
+import random
+import re
+import sys
+import threading
+import time
+
+from array import array
+
+from fuzzy import FuzzyIndex
+from simhash import normalize, simhash, hamming, bands, near_distance
+from triggertable import TriggerTable
+
+# Bump whenever the matcher's innards change shape
+snapshot_version = 7
+
+event_types = ('JOIN', 'EXIT')
+
+tokenizer = re.compile(r'[\w:;=]+', re.UNICODE)
+
+def filter_message(message):
+    return re.sub(r'[\-\$\+\~\?]', ' ', message.lower())
+
+def tokenize(text):
+    # Same as the analyzer on the trigger field
+    return tokenizer.findall(text.lower())
+
+Trigger = namedtuple('Trigger', 'trigger querytype response useaction channel')
+
+def make_trigger(fields):
+    return Trigger(filter_message(fields['trigger']), fields['querytype'],
+                   fields['response'], bool(fields.get('useaction')),
+                   fields.get('channel') or None)
+
+def dupe_key(fields):
+    # Two triggers with the same key are the same trigger, whatever the
+    # capitalisation of the trigger or the spacing of the response
+    trigger = make_trigger(fields)
+    return (trigger.trigger, trigger.querytype, normalize(trigger.response),
+            trigger.useaction, trigger.channel)
+
+def table_trigger(table, row):
+    return Trigger(table.trigger(row), table.querytype(row),
+                   table.response(row), table.useaction(row),
+                   table.channel(row))
+
+class Candidates:
+    # What match() hands back: row numbers, best first, only turned into
+    # Triggers when somebody looks. Usually that's just the one random.choice()
+    # picks. scores are how similar each one is to the message, 1.0 for
+    # anything but a fuzzy match.
+    __slots__ = ('table', 'rows', 'scores')
+
+    def __init__(self, table, rows, scores):
+        self.table = table
+        self.rows = rows
+        self.scores = scores
+
+    def above(self, threshold):
+        keep = [i for i, score in enumerate(self.scores) if score >= threshold]
+        if len(keep) == len(self.rows): return self
+
+        return Candidates(self.table, tuple(self.rows[i] for i in keep),
+                          tuple(self.scores[i] for i in keep))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [table_trigger(self.table, row) for row in self.rows[index]]
+        return table_trigger(self.table, self.rows[index])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield table_trigger(self.table, row)
+
+    def __repr__(self):
+        return 'Candidates({!r})'.format(list(self))
+
+def sizeof(obj, seen):
+    # Deep size of the containers we use; anything reached twice, like a
+    # token in both fuzzy and fuzzyindex, only counts once
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sizeof(key, seen) + sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += sizeof(item, seen)
+
+    return size
+
+def copy_buckets(buckets):
+    # key -> rows, with the lists copied as well
+    return defaultdict(list, ((key, rows[:]) for key, rows in buckets.items()))
+
+def pick_response(candidates):
+    if not candidates: return None
+
+    result = random.choice(candidates)
+
+    # XXX FIXME a hack for now!
+    response = result.response
+    if result.useaction:
+        response = '\x01ACTION ' + response + '\x01'
+
+    return response
+
+class Automaton:
+    # Aho-Corasick over the MATCHALL patterns. Adds and removes only touch the
+    # trie; the failure links are rebuilt lazily on the next search.
+
+    def __init__(self):
+        self.goto = [{}]
+        self.terminal = [None]
+        self.fail = [0]
+        self.out = [()]
+        self.dirty = False
+
+    def add(self, pattern):
+        node = 0
+        for c in pattern:
+            nxt = self.goto[node].get(c)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.terminal.append(None)
+                self.goto[node][c] = nxt
+            node = nxt
+
+        self.terminal[node] = pattern
+        self.dirty = True
+
+    def remove(self, pattern):
+        node = 0
+        for c in pattern:
+            node = self.goto[node].get(c)
+            if node is None: return
+
+        self.terminal[node] = None
+        self.dirty = True
+
+    def build(self):
+        count = len(self.goto)
+        self.fail = [0] * count
+        self.out = [()] * count
+
+        queue = deque()
+        for nxt in self.goto[0].values():
+            queue.append(nxt)
+            self.out[nxt] = (self.terminal[nxt],) if self.terminal[nxt] else ()
+
+        while queue:
+            node = queue.popleft()
+            for c, nxt in self.goto[node].items():
+                queue.append(nxt)
+
+                f = self.fail[node]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(c, 0)
+                if f == nxt: f = 0
+
+                self.fail[nxt] = f
+                out = self.out[f]
+                if self.terminal[nxt]:
+                    out = (self.terminal[nxt],) + out
+                self.out[nxt] = out
+
+        self.dirty = False
+
+    def search(self, text):
+        if self.dirty: self.build()
+
+        found = set()
+        node = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c, 0)
+            if out[node]: found.update(out[node])
+
+        return found
+
+class ResultCache:
+    # LRU of normalised message -> candidate triggers. Only the candidates are
+    # kept, the pick is still made fresh every time. Entries go stale after ttl
+    # seconds or as soon as the matcher generation moves on.
+
+    def __init__(self, maxsize=4096, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        entry = self.entries.get(key)
+        if entry is not None:
+            results, entrygen, expires = entry
+            if entrygen == generation and expires > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return results
+
+            del self.entries[key]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, generation, results):
+        self.entries[key] = (results, generation, time.time() + self.ttl)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+class TriggerMatcher:
+    def __init__(self, fuzzy_maxdist=1, fuzzy_prefix=1):
+        # The triggers themselves; everything else just holds row numbers
+        self.table = TriggerTable()
+
+        self.literal = defaultdict(list)
+        self.matchall = defaultdict(list)
+        self.automaton = Automaton()
+        self.fuzzy = defaultdict(list)   # token -> rows
+        self.fuzzyindex = FuzzyIndex(fuzzy_maxdist, fuzzy_prefix)
+        self.tokencounts = array('B')    # distinct tokens, per FUZZY row
+
+        # Response SimHashes, per row; 0 until somebody needs one. Event
+        # responses aren't filed under their trigger, so those get theirs
+        # straight away and are found by band instead.
+        self.signatures = array('Q')
+        self.eventbands = defaultdict(list)  # (querytype, band) -> rows
+
+        # Channel event responses, picked at random. (event, channel) -> rows,
+        # with channel None for the ones that go everywhere.
+        self.events = defaultdict(list)
+
+        # Bumped on every change, so anything derived from us can tell
+        self.generation = 0
+
+        self.cache = ResultCache()
+
+        # Lookups may run on a worker thread while changes come from the read
+        # loop
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        return {k : v for k, v in self.__dict__.items()
+                if k not in ('lock', 'cache')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = ResultCache()
+        self.lock = threading.RLock()
+
+        # Left out by snapshot(), they're quicker to make again than to copy
+        if self.automaton is None:
+            self.automaton = Automaton()
+            for pattern in self.matchall:
+                self.automaton.add(pattern)
+        if self.fuzzy and not self.fuzzyindex.keys:
+            for token in self.fuzzy:
+                self.fuzzyindex.add(token)
+
+    def snapshot(self):
+        # A copy of us that can be pickled without the lock, which the caller
+        # holds while this runs. Just the containers that change in place are
+        # copied; the automaton and fuzzyindex are only the MATCHALL patterns
+        # and FUZZY tokens over again, so they're made again on load.
+        copied = TriggerMatcher.__new__(TriggerMatcher)
+        copied.__dict__.update(self.__getstate__())
+        copied.table = self.table.copy()
+        copied.literal = copy_buckets(self.literal)
+        copied.matchall = copy_buckets(self.matchall)
+        copied.automaton = None
+        copied.fuzzy = copy_buckets(self.fuzzy)
+        copied.fuzzyindex = FuzzyIndex(self.fuzzyindex.maxdist,
+                                       self.fuzzyindex.prefixlength)
+        copied.tokencounts = array('B', self.tokencounts)
+        copied.signatures = array('Q', self.signatures)
+        copied.eventbands = copy_buckets(self.eventbands)
+        copied.events = copy_buckets(self.events)
+
+        return copied
+
+    @classmethod
+    def from_hive(cls, hive, **kwargs):
+        matcher = cls(**kwargs)
+        for key in hive.keys():
+            with hive.get(key).searcher() as searcher:
+                for fields in searcher.all_stored_fields():
+                    matcher.add(fields)
+
+        return matcher
+
+    def get(self, row):
+        return table_trigger(self.table, row)
+
+    def memory(self):
+        # Everything, not just the table. This walks every bucket, so it's
+        # for startup and bench.py, not for polling.
+        with self.lock:
+            table = self.table.memory()
+            automaton = self.automaton
+            seen = set()
+            parts = OrderedDict([
+                ('table', table['total_bytes']),
+                ('literal', sizeof(self.literal, seen)),
+                ('matchall', sizeof(self.matchall, seen)),
+                ('automaton', sum(sizeof(x, seen) for x in (
+                    automaton.goto, automaton.terminal, automaton.fail,
+                    automaton.out))),
+                ('fuzzy', sizeof(self.fuzzy, seen)),
+                ('fuzzyindex', sizeof(self.fuzzyindex.keys, seen)),
+                ('tokencounts', sys.getsizeof(self.tokencounts)),
+                ('signatures', sys.getsizeof(self.signatures)),
+                ('events', sizeof(self.events, seen) +
+                           sizeof(self.eventbands, seen)),
+            ])
+
+        total = sum(parts.values())
+        return {
+            'live' : table['live'],
+            'total_bytes' : total,
+            'bytes_per_trigger' : total / max(table['rows'], 1),
+            'parts' : parts,
+            'table' : table,
+        }
+
+    def add(self, fields):
+        with self.lock:
+            self._add(make_trigger(fields))
+
+    def _add(self, trigger, signature=0):
+        querytype = trigger.querytype
+        if querytype not in ('LITERAL', 'MATCHALL', 'FUZZY') + event_types:
+            return
+
+        row = self.table.append(*trigger)
+        tokens = set(tokenize(trigger.trigger)) if querytype == 'FUZZY' else ()
+        self.tokencounts.append(min(len(tokens), 255))
+        if querytype in event_types and not signature:
+            signature = simhash(trigger.response)
+        self.signatures.append(signature)
+
+        if querytype == 'LITERAL':
+            self.literal[trigger.trigger].append(row)
+        elif querytype == 'MATCHALL':
+            if trigger.trigger not in self.matchall:
+                self.automaton.add(trigger.trigger)
+            self.matchall[trigger.trigger].append(row)
+        elif querytype == 'FUZZY':
+            for token in tokens:
+                if token not in self.fuzzy:
+                    self.fuzzyindex.add(token)
+                self.fuzzy[token].append(row)
+        else:
+            self.events[querytype, trigger.channel].append(row)
+            for band in bands(signature):
+                self.eventbands[querytype, band].append(row)
+
+        self.generation += 1
+
+    def remove(self, fields):
+        with self.lock:
+            self._remove(make_trigger(fields))
+            if self.table.wasteful(): self._rebuild()
+
+    def _find(self, bucket, trigger):
+        for row in bucket:
+            if self.get(row) == trigger: return row
+
+        return None
+
+    def _remove(self, trigger):
+        querytype = trigger.querytype
+
+        if querytype == 'LITERAL':
+            row = self._find(self.literal.get(trigger.trigger, ()), trigger)
+            if row is None: return
+            self._discard(self.literal, trigger.trigger, row)
+        elif querytype == 'MATCHALL':
+            row = self._find(self.matchall.get(trigger.trigger, ()), trigger)
+            if row is None: return
+            self._discard(self.matchall, trigger.trigger, row)
+            if trigger.trigger not in self.matchall:
+                self.automaton.remove(trigger.trigger)
+        elif querytype == 'FUZZY':
+            tokens = set(tokenize(trigger.trigger))
+            if not tokens: return
+
+            row = self._find(self.fuzzy.get(next(iter(tokens)), ()), trigger)
+            if row is None: return
+            for token in tokens:
+                if (self._discard(self.fuzzy, token, row) and
+                        token not in self.fuzzy):
+                    self.fuzzyindex.remove(token)
+        elif querytype in event_types:
+            key = (querytype, trigger.channel)
+            row = self._find(self.events.get(key, ()), trigger)
+            if row is None: return
+            self._discard(self.events, key, row)
+            for band in bands(self.signatures[row]):
+                self._discard(self.eventbands, (querytype, band), row)
+        else:
+            return
+
+        self.table.delete(row)
+        self.generation += 1
+
+    def _discard(self, table, key, row):
+        if key not in table: return False
+
+        bucket = table[key]
+        try:
+            bucket.remove(row)
+        except ValueError:
+            return False
+
+        if not bucket: del table[key]
+        return True
+
+    def signature(self, row):
+        signature = self.signatures[row]
+        if not signature:
+            signature = self.signatures[row] = simhash(self.table.response(row))
+
+        return signature
+
+    def bucket(self, trigger, signature):
+        # Rows that could be duplicates: those filed under the same trigger.
+        # The buckets are already hashed on it, bar FUZZY which goes by token,
+        # so this is cheap.
+        querytype = trigger.querytype
+
+        if querytype == 'LITERAL':
+            return self.literal.get(trigger.trigger, ())
+        elif querytype == 'MATCHALL':
+            return self.matchall.get(trigger.trigger, ())
+        elif querytype == 'FUZZY':
+            tokens = set(tokenize(trigger.trigger))
+            if not tokens: return ()
+
+            rarest = min(tokens, key=lambda t: len(self.fuzzy.get(t, ())))
+            return [row for row in self.fuzzy.get(rarest, ())
+                    if self.table.trigger(row) == trigger.trigger]
+        elif querytype in event_types:
+            # Any of them can come up for the event, whatever the trigger
+            # says, and there can be thousands. Anything near enough agrees
+            # with us on at least one band.
+            rows = set()
+            for band in bands(signature):
+                rows.update(self.eventbands.get((querytype, band), ()))
+            return rows
+
+        return ()
+
+    def duplicates(self, fields, distance=near_distance):
+        # (exact, near) Triggers already in the hive that would answer the
+        # same thing wherever this one would. Exact is the same response give
+        # or take spacing; near is a SimHash within distance bits, which also
+        # catches case, punctuation and /me differences. distance can't be
+        # more than near_distance, that's what the bands are cut for.
+        trigger = make_trigger(fields)
+        response = normalize(trigger.response)
+        signature = simhash(response)
+        exact, near = [], []
+
+        with self.lock:
+            for row in sorted(self.bucket(trigger, signature)):
+                # A global one already covers every channel, but not the
+                # other way round
+                if self.table.channel(row) not in (None, trigger.channel):
+                    continue
+
+                # The same response always has the same SimHash
+                if hamming(signature, self.signature(row)) > distance:
+                    continue
+
+                if (normalize(self.table.response(row)) == response and
+                        self.table.useaction(row) == trigger.useaction):
+                    exact.append(self.get(row))
+                else:
+                    near.append(self.get(row))
+
+        return exact, near
+
+    def _rebuild(self):
+        # Row numbers are baked into every bucket, so the only way to drop the
+        # dead ones is to start over. That's done off to the side and then
+        # swapped in whole, keeping our lock; the caller holds the lock, so
+        # nobody sees it half done. Everything cached is for the old rows, so
+        # that goes rather than sitting there until it's pushed out.
+        old, signatures = self.table, self.signatures
+        fresh = TriggerMatcher(self.fuzzyindex.maxdist,
+                               self.fuzzyindex.prefixlength)
+        for row in old.rows():
+            fresh._add(table_trigger(old, row), signatures[row])
+
+        fresh.generation = self.generation + 1
+        self.__dict__.update(fresh.__getstate__())
+        self.cache.clear()
+
+    def event_response(self, event, channel=None):
+        # Every network's read loop calls this, so it needs the lock as much
+        # as match() does
+        with self.lock:
+            # The ones that go everywhere and the channel's own, picked from
+            # as if they were one pool
+            everywhere = self.events.get((event, None), ())
+            here = self.events.get((event, channel), ()) if channel else ()
+            total = len(everywhere) + len(here)
+            if not total: return None
+
+            i = random.randrange(total)
+            if i < len(everywhere):
+                row = everywhere[i]
+            else:
+                row = here[i - len(everywhere)]
+
+            return self.table.response(row)
+
+    def match(self, message, channel=None):
+        message = filter_message(message)
+        key = (channel, message)
+
+        with self.lock:
+            results = self.cache.get(key, self.generation)
+            if results is None:
+                results = self.lookup(message, channel)
+                self.cache.put(key, self.generation, results)
+
+        return results
+
+    def lookup(self, message, channel=None):
+        rows = []
+
+        rows.extend(self.literal.get(message, ()))
+
+        if self.matchall:
+            for pattern in self.automaton.search(message):
+                rows.extend(self.matchall[pattern])
+
+        scores = [1.0] * len(rows)
+
+        if self.fuzzy:
+            # A fuzzy trigger scores the best similarity each of its tokens
+            # got, averaged over all of them, so matching one word out of
+            # three counts for a third at most
+            best = {}
+            for token in set(tokenize(message)):
+                for found, sim in self.fuzzyindex.lookup(token).items():
+                    for row in self.fuzzy[found]:
+                        sims = best.get(row)
+                        if sims is None:
+                            best[row] = {found : sim}
+                        elif sim > sims.get(found, 0):
+                            sims[found] = sim
+
+            counts = self.tokencounts
+            picked = sorted([(-sum(sims.values()) / counts[row], row)
+                             for row, sims in best.items()])
+            rows.extend(row for score, row in picked)
+            scores.extend(-score for score, row in picked)
+
+        if self.table.scoped():
+            visible = set(self.table.visible(rows, channel))
+            keep = [i for i, row in enumerate(rows) if row in visible]
+            rows = [rows[i] for i in keep]
+            scores = [scores[i] for i in keep]
+
+        return Candidates(self.table, tuple(rows), tuple(scores))
+
+def dump_snapshot(matcher, generation, hive=None):
+    # matcher should be from matcher.snapshot(), taken under the lock, so what
+    # we pickle matches generation and nobody waits on the pickling. hive is whatever says which hive that is: a freshly built one can
+    # easily have the same generations as the one it replaced.
+    return pickle.dumps({'version' : snapshot_version, 'hive' : hive,
+                         'generation' : generation, 'matcher' : matcher},
+                        pickle.HIGHEST_PROTOCOL)
+
+def write_snapshot(data, path):
+    # No need for the lock here, it's just bytes by now
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as f:
+        f.write(data)
+    os.replace(tmppath, path)
+
+def load_snapshot(path, generation, hive=None):
+    # The matcher, if there's a snapshot for this exact hive and generation
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError, TypeError, KeyError):
+        # Whatever's wrong with it, a rebuild fixes it
+        return None
+
+    if not isinstance(snapshot, dict): return None
+    if snapshot.get('version') != snapshot_version: return None
+    if snapshot.get('hive') != hive: return None
+    if snapshot.get('generation') != generation: return None
+
+    return snapshot['matcher']
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Counters and latency histograms, dumped in Prometheus text format.
+
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+import os
+import threading
+import time
+
+# Upper bounds in seconds
+default_buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+                   0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+class Histogram:
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket the quantile lands in; good enough
+        if not self.count: return 0
+
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted: return bound
+
+        return float('inf')
+
+class Metrics:
+    def __init__(self, prefix='socky'):
+        self.prefix = prefix
+        self.counters = OrderedDict()
+        self.histograms = OrderedDict()
+        self.gauges = OrderedDict()
+
+        self.writer = None
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, func):
+        # func is called whenever the numbers are read
+        self.gauges[name] = func
+
+    def timed(self, name, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - start)
+
+        return wrapper
+
+    def get(self, name):
+        if name in self.counters:
+            return self.counters[name]
+        elif name in self.gauges:
+            return self.gauges[name]()
+        else:
+            return 0
+
+    def render(self):
+        out = []
+        for name, value in list(self.counters.items()):
+            name = '{}_{}_total'.format(self.prefix, name)
+            out.append('# TYPE {} counter'.format(name))
+            out.append('{} {}'.format(name, value))
+
+        for name, func in list(self.gauges.items()):
+            name = '{}_{}'.format(self.prefix, name)
+            out.append('# TYPE {} gauge'.format(name))
+            out.append('{} {}'.format(name, func()))
+
+        for name, histogram in list(self.histograms.items()):
+            name = '{}_{}_seconds'.format(self.prefix, name)
+            out.append('# TYPE {} histogram'.format(name))
+
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                out.append('{}_bucket{{le="{}"}} {}'.format(name, bound,
+                                                           cumulative))
+            out.append('{}_bucket{{le="+Inf"}} {}'.format(name, histogram.count))
+            out.append('{}_sum {}'.format(name, histogram.total))
+            out.append('{}_count {}'.format(name, histogram.count))
+
+        return '\n'.join(out) + '\n'
+
+    def write(self, path):
+        # Write then rename so scrapers never see half a file
+        tmppath = path + '.tmp'
+        with open(tmppath, 'w') as f:
+            f.write(self.render())
+        os.replace(tmppath, path)
+
+    def start_writer(self, path, interval=60):
+        def run():
+            try:
+                self.write(path)
+            except OSError as e:
+                print('Could not write metrics:', e)
+
+            self.start_writer(path, interval)
+
+        self.writer = threading.Timer(interval, run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def stop_writer(self):
+        if self.writer:
+            self.writer.cancel()
+            self.writer = None
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# On-demand cProfile for a running bot. cProfile hooks the thread that turns
+# it on and nothing else, so there's one profile per thread we care about:
+# the network's read loop that asked, for the dispatch handlers, and the
+# worker, where the matching and searching actually happen. They're merged
+# when it's done. Nothing is wrapped and no hooks are left behind, so when
+# it's off it costs nothing.
+
+import cProfile
+import os
+import pstats
+import threading
+import time
+
+class Profiler:
+    def __init__(self):
+        self.profiles = {}      # thread ident -> profile
+        self.started = None
+        self.owner = None
+        self.stopping = False
+
+        # Bumped every run, so a stop timer from an old run can tell
+        self.runs = 0
+
+    @property
+    def running(self):
+        return self.owner is not None
+
+    def start(self, owner):
+        # Profiles the calling thread; attach() any others from their own
+        if self.running:
+            raise RuntimeError('Already profiling ' + str(self.owner))
+
+        self.started = time.time()
+        self.owner = owner
+        self.stopping = False
+        self.runs += 1
+        self.attach()
+
+        return self.runs
+
+    def attach(self):
+        if threading.get_ident() in self.profiles: return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer Pythons only allow one, and it sees every thread anyway
+            return
+
+        self.profiles[threading.get_ident()] = profile
+
+    def detach(self):
+        # Has to be the thread that attached, cProfile won't have it any
+        # other way
+        profile = self.profiles.get(threading.get_ident())
+        if profile: profile.disable()
+
+    def finish(self, path):
+        # Once every thread has detached
+        elapsed = time.time() - self.started
+
+        stats = pstats.Stats(*self.profiles.values())
+        stats.dump_stats(path)
+        self.profiles = {}
+        self.owner = None
+
+        return stats, elapsed
+
+def label(key):
+    filename, line, func = key
+    if filename == '~': return func    # builtins
+
+    return '{}:{}'.format(os.path.basename(filename), func)
+
+def top(stats, count=5):
+    # [(label, seconds, calls)] spending the most time in themselves
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2],
+                  reverse=True)
+    return [(label(key), tt, nc) for key, (cc, nc, tt, ct, callers)
+            in rows[:count]]
+
+def handlers(stats, prefix='handle_'):
+    # [(label, seconds, calls)] for the dispatch handlers, all in
+    rows = [(label(key), ct, nc) for key, (cc, nc, tt, ct, callers)
+            in stats.stats.items() if key[2].startswith(prefix)]
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows
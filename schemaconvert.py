@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
+# Migrate the hive to a new schema. Documents are streamed out of each old
+# shard in chunks into a fresh directory, which is then swapped in for the
+# old one, so we never hold the whole hive in memory and a crash half way
+# through leaves the old hive alone.
+
 from datetime import datetime
+import argparse
+import os
+import shutil
+import time
 
 from whoosh.fields import Schema, TEXT, STORED, ID, DATETIME, BOOLEAN
-from whoosh.index import create_in, open_dir
+from whoosh.index import create_in, open_dir, exists_in
 from whoosh.analysis import RegexTokenizer, LowercaseFilter
 
-# Define the NEW schema here
+# Define the NEW schema here, and what to give documents that predate a field
 defaultvalues = {
     # new schema values
     'who' : 'Elizacat',
@@ -18,18 +27,127 @@ trigtype = TEXT(stored=True, chars=True, analyzer=analyzer)
 schema = Schema(trigger=trigtype, querytype=ID(stored=True),
                 useaction=BOOLEAN(stored=True),
                 response=TEXT(stored=True, chars=True), who=ID(stored=True),
-                time=DATETIME(stored=True))
+                time=DATETIME(stored=True), channel=ID(stored=True))
+
+def fresh_dest(source):
+    # Somewhere new to build into. A fixed name is no good: once index is a
+    # symlink to it, the next run would wipe the live hive.
+    dest = '{}.{}'.format(source, time.strftime('%Y%m%d-%H%M%S'))
+    while os.path.exists(dest):
+        dest += '_'
+
+    return dest
+
+def check_dest(source, dest):
+    if os.path.realpath(dest) == os.path.realpath(source):
+        raise ValueError('{} is {}, refusing to build over the live '
+                         'hive'.format(dest, source))
+
+def swap_dirs(source, dest):
+    # If the index is a symlink, flipping it is atomic. Otherwise move the old
+    # one out of the way and keep it around, just in case.
+    if os.path.islink(source):
+        oldtarget = os.readlink(source)
+        tmplink = source + '.tmp'
+        os.symlink(os.path.abspath(dest), tmplink)
+        os.replace(tmplink, source)
+        return oldtarget
+
+    backup = '{}.old-{}'.format(source, int(time.time()))
+    os.rename(source, backup)
+    os.rename(dest, source)
+    return backup
+
+def migrate_index(source, dest, chunk=1000, procs=1, optimize=False):
+    os.mkdir(dest)
+
+    oldix = open_dir(source)
+    newix = create_in(dest, schema)
+
+    total = oldix.doc_count()
+    done = 0
+    start = time.time()
+
+    with oldix.searcher() as searcher:
+        docs = searcher.documents()
+        while True:
+            writer = newix.writer(procs=procs, multisegment=(procs > 1))
+
+            count = 0
+            for x in docs:
+                # Only fill in what's missing, never clobber what's there
+                for k, v in defaultvalues.items():
+                    x.setdefault(k, v)
+                writer.add_document(**x)
+
+                count += 1
+                if count >= chunk: break
+
+            if not count:
+                writer.cancel()
+                break
+
+            writer.commit()
+            done += count
+
+            elapsed = time.time() - start
+            print('{}: {}/{} documents, {:.0f} docs/sec'.format(
+                os.path.basename(source), done, total,
+                done / elapsed if elapsed else 0))
+
+    if optimize:
+        newix.optimize()
+
+    oldix.close()
+    newix.close()
+
+    return done
+
+def migrate(source, dest, chunk=1000, procs=1, optimize=False):
+    # Shard by shard; they all have the same schema. An old single index has
+    # no shards, and would come out empty.
+    if exists_in(source):
+        raise ValueError('{} is an unsharded index, split it with '
+                         'shardhive.py first'.format(source))
+    check_dest(source, dest)
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+    os.mkdir(dest)
 
-ix = open_dir("index")
+    done = 0
+    start = time.time()
+    for name in sorted(os.listdir(source)):
+        if not os.path.isdir(os.path.join(source, name)): continue
+        done += migrate_index(os.path.join(source, name),
+                              os.path.join(dest, name), chunk, procs, optimize)
 
-docs = [x for x in ix.searcher().documents()]
-ix.close()
+    return done, time.time() - start
 
-ix = create_in("index", schema)
-writer = ix.writer()
-for x in docs:
-    x.update(defaultvalues)
-    writer.add_document(**x)
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Migrate the hive to a '
+                                        'new schema')
+    argparser.add_argument('--index', default='index',
+                           help='index directory to migrate')
+    argparser.add_argument('--dest', default=None,
+                           help='directory to build the new index in')
+    argparser.add_argument('--chunk', type=int, default=1000,
+                           help='documents per commit')
+    argparser.add_argument('--procs', type=int, default=1,
+                           help='indexing processes per commit')
+    argparser.add_argument('--optimize', action='store_true',
+                           help='merge down to one segment at the end')
+    argparser.add_argument('--no-swap', action='store_true',
+                           help='leave the new index where it is')
+    args = argparser.parse_args()
 
-writer.commit()
+    dest = args.dest or fresh_dest(args.index)
+    try:
+        done, elapsed = migrate(args.index, dest, args.chunk, args.procs,
+                                args.optimize)
+    except ValueError as e:
+        argparser.error(str(e))
+    print('Migrated {} documents in {:.2f} seconds'.format(done, elapsed))
 
+    if not args.no_swap:
+        old = swap_dirs(args.index, dest)
+        print('Old index is at', old)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Outbound pacing. Lines go out through a token bucket so we don't get
+# flood-killed, admin replies jump ahead of chatter, and long output is packed
+# by how many bytes the server will actually relay, not by characters.
+
+from itertools import count
+import heapq
+import time
+
+from workers import ADMIN
+
+# What the server relays is ":nick!user@host PRIVMSG target :text\r\n" and
+# that has to fit in 512 bytes. We don't reliably know our own user@host, so
+# assume the worst.
+max_line = 512
+max_userhost = 10 + 1 + 63
+
+def byte_budget(nick, target, command='PRIVMSG'):
+    overhead = len(':{}!{} {} {} :\r\n'.format(nick, 'x' * max_userhost,
+                                               command, target).encode('utf-8'))
+    return max_line - overhead
+
+def truncate_bytes(text, budget):
+    # Cut at a character boundary, never in the middle of a UTF-8 sequence
+    encoded = text.encode('utf-8')
+    if len(encoded) <= budget: return text
+
+    return encoded[:max(budget, 0)].decode('utf-8', 'ignore')
+
+def pack_lines(start, items, end, budget, sep=' & '):
+    # Join items into as few lines as fit the budget, each line wrapped in
+    # start ... end. An item too big for a line on its own gets truncated,
+    # and so does a start that would leave less than half a line for items
+    # (it has a trigger in it, so it can be anything).
+    endlen = len(end.encode('utf-8'))
+    if len(start.encode('utf-8')) + endlen > budget // 2:
+        start = truncate_bytes(start, budget // 2 - endlen)
+
+    fixed = len((start + end).encode('utf-8'))
+    seplen = len(sep.encode('utf-8'))
+
+    lines = []
+    current = []
+    used = fixed
+    for item in items:
+        size = len(item.encode('utf-8'))
+        if size + fixed > budget:
+            item = truncate_bytes(item, budget - fixed)
+            size = len(item.encode('utf-8'))
+
+        extra = size + (seplen if current else 0)
+        if current and used + extra > budget:
+            lines.append(start + sep.join(current) + end)
+            current = []
+            used = fixed
+            extra = size
+
+        current.append(item)
+        used += extra
+
+    if current:
+        lines.append(start + sep.join(current) + end)
+
+    return lines
+
+class SendQueue:
+    def __init__(self, client, rate=0.5, burst=5, maxdepth=50, metrics=None):
+        self.client = client
+        self.rate = rate        # lines per second, once the burst is used up
+        self.burst = burst
+        self.maxdepth = maxdepth
+        self.metrics = metrics
+
+        self.tokens = burst
+        self.last = time.time()
+        self.queue = []
+        self.seq = count()
+        self.scheduled = False
+
+    def depth(self):
+        return len(self.queue)
+
+    def send(self, command, params, priority=ADMIN):
+        if priority != ADMIN and len(self.queue) >= self.maxdepth:
+            # Chatter can go, nobody will miss it
+            if self.metrics: self.metrics.incr('send_dropped')
+            return False
+
+        heapq.heappush(self.queue, (priority, next(self.seq), time.time(),
+                                    command, params))
+        if not self.scheduled: self.drain()
+        return True
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def drain(self):
+        self.scheduled = False
+
+        now = time.time()
+        self.refill(now)
+        while self.queue and self.tokens >= 1:
+            priority, seq, queued, command, params = heapq.heappop(self.queue)
+            self.tokens -= 1
+            self.client.cmdwrite(command, params)
+
+            if self.metrics:
+                self.metrics.incr('sent_lines')
+                self.metrics.observe('send_wait', now - queued)
+
+        if self.queue:
+            self.scheduled = True
+            self.client.timer_oneshot('socky_sendqueue',
+                                      (1 - self.tokens) / self.rate, self.drain)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Split an old single-index hive into shards. Documents are streamed out of
+# the old index into a fresh sharded directory next to it, which is then
+# swapped in like schemaconvert.py does. Everything in the old index applies
+# everywhere, so it all goes into the unscoped querytype shards.
+
+import argparse
+import os
+import shutil
+import time
+
+from whoosh.index import open_dir, exists_in
+
+from hive import ShardedHive, shard_key, shard_label
+from journal import Journal
+from schemaconvert import swap_dirs
+
+def shard(source, dest, chunk=10000):
+    if os.path.exists(dest):
+        shutil.rmtree(dest)
+
+    oldix = open_dir(source)
+    hive = ShardedHive(dest)
+
+    total = oldix.doc_count()
+    counts = {}
+    done = 0
+    start = time.time()
+
+    with oldix.searcher() as searcher:
+        docs = searcher.documents()
+        while True:
+            # One writer per shard, all committed together every chunk
+            writers = {}
+            count = 0
+            for doc in docs:
+                key = shard_key(doc)
+                if key not in writers:
+                    writers[key] = hive.get(key, create=True).writer()
+                writers[key].add_document(**doc)
+                counts[key] = counts.get(key, 0) + 1
+
+                count += 1
+                if count >= chunk: break
+
+            if not count: break
+
+            for writer in writers.values():
+                writer.commit()
+            done += count
+
+            elapsed = time.time() - start
+            print('{}/{} documents, {:.0f} docs/sec'.format(
+                done, total, done / elapsed if elapsed else 0))
+
+    oldix.close()
+    hive.close()
+
+    return counts, time.time() - start
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Split a single index '
+                                        'hive into shards')
+    argparser.add_argument('--index', default='index',
+                           help='index directory to split')
+    argparser.add_argument('--dest', default=None,
+                           help='directory to build the shards in')
+    argparser.add_argument('--chunk', type=int, default=10000,
+                           help='documents per commit')
+    argparser.add_argument('--no-swap', action='store_true',
+                           help='leave the sharded hive where it is')
+    args = argparser.parse_args()
+
+    if not exists_in(args.index):
+        argparser.error('{} is not a single index hive'.format(args.index))
+
+    # A journal still holding changes was written against the old layout;
+    # start and stop the bot once so they go into the index first
+    journal = Journal(args.index + '.journal')
+    pending = journal.entries()
+    journal.close()
+    if pending:
+        argparser.error('{}.journal is not empty, replay it first'.format(
+            args.index))
+
+    dest = args.dest or args.index + '.new'
+    counts, elapsed = shard(args.index, dest, args.chunk)
+    for key in sorted(counts, key=shard_label):
+        print('{}: {} documents'.format(shard_label(key), counts[key]))
+    print('Sharded {} documents in {:.2f} seconds'.format(
+        sum(counts.values()), elapsed))
+
+    if not args.no_swap:
+        old = swap_dirs(args.index, dest)
+        print('Old index is at', old)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Near-duplicate detection for responses. A SimHash is 64 bits where each bit
+# is a majority vote over the hashes of the text's character trigrams, so two
+# texts that share most of their trigrams land only a few bits apart.
+# Case, punctuation and spacing are ignored altogether.
+
+from hashlib import blake2b
+import re
+
+bits = 64
+
+# Up to this many bits apart counts as near enough
+near_distance = 3
+
+words = re.compile(r'\w+', re.UNICODE)
+
+def normalize(text):
+    # What counts as the same response: just the spacing can differ
+    return ' '.join(text.split())
+
+def features(text):
+    text = ' '.join(words.findall(text.casefold()))
+    if len(text) <= 3: return [text]
+
+    return [text[i:i + 3] for i in range(len(text) - 2)]
+
+def feature_hash(feature):
+    # Not hash(), that's salted per process and these get kept in snapshots
+    digest = blake2b(feature.encode('utf-8'), digest_size=bits // 8).digest()
+    return int.from_bytes(digest, 'big')
+
+def simhash(text):
+    hashes = [format(feature_hash(f), '064b') for f in features(text)]
+    half = len(hashes) / 2
+
+    value = 0
+    for column in zip(*hashes):
+        value <<= 1
+        if column.count('1') > half: value |= 1
+
+    return value
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+def bands(value, count=near_distance + 1):
+    # Split into count pieces. Anything within count - 1 bits of value has to
+    # agree with it on at least one piece, so these make good bucket keys.
+    width = bits // count
+    return [(i, (value >> (i * width)) & ((1 << width) - 1))
+            for i in range(count)]
@@ -1,24 +1,42 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-from whoosh.fields import Schema, TEXT, STORED, ID, DATETIME, BOOLEAN
-from whoosh.index import create_in, open_dir
-from whoosh.query import Term, FuzzyTerm, Or, And
-from whoosh.analysis import RegexTokenizer, LowercaseFilter 
-
 from PyIRC.client import client
 from PyIRC.common.line import Line
 
+from matcher import (TriggerMatcher, filter_message, pick_response,
+                     dump_snapshot, write_snapshot, load_snapshot)
+from hive import (ShardedSearcher, BatchWriter, QueryExpander, open_hive,
+                  shard_label, parse_label)
+from journal import Journal
+from config import ConfigStore
+from metrics import Metrics
+from workers import WorkerPool, ADMIN, CHATTER
+from cooldown import Cooldowns
+from sendqueue import SendQueue, byte_budget, pack_lines
+from cursors import Cursor, CursorStore
+from profiler import Profiler, top, handlers
+
 from datetime import datetime
 from functools import partial
 from collections import OrderedDict, defaultdict
-import shelve
+import argparse
 import random
 import os, time
+import pickle
+import queue
 import re
+import threading
 
 # Globals deaugh
-ix = None
+# These are shared between all the networks we're on
+hive = None
+matcher = None
+expander = None
+searcher = None
+writer = None
+workers = None
+metrics = None
 
 parser = re.compile("""
     (?:\s+)?        # Leading whitespace
@@ -27,7 +45,7 @@ parser = re.compile("""
     ([~!=@\-\#\$])  # Type of command (addition predicates ~!=), @ (search), -
                     # (delete), # (chan event), or $ (command)
     (?:\s+)?        # Eat whitespace
-    \[(.+)\]        # Second portion
+    \[(.*)\]        # Second portion (may be empty for commands)
     (?:\s+)?        # Eat trailing whitespace
 """, re.VERBOSE|re.UNICODE)
 
@@ -38,46 +56,57 @@ admins = ['Elizacat', 'SilentPenguin']
 default_interval = 300
 default_shutup = 3600 - default_interval # an hour
 
+# Where and how often to dump metrics
+metrics_file = 'socky.prom'
+metrics_interval = 60
+
+# Matcher snapshot, so restarts don't have to rebuild it from the hive
+snapshot_interval = 300
+
+# How often to look for a hive that's been flipped under us (0 to not)
+swap_check_interval = 10
+
+# $ [profile] windows, in seconds, how much of it to reply with, and where the
+# pstats files go
+profile_window = 30
+profile_max_window = 300
+profile_top = 5
+profile_dir = '.'
+
+# How often the read loop picks up results from the other threads, in seconds
+completion_interval = 0.05
+
+# Reconnect backoff, in seconds
+reconnect_base = 1
+reconnect_cap = 300
+
+# Search results per page, and how long to hold on to the rest
+search_pagelen = 10
+search_ttl = 300
+
+# Fuzzy tuning, for both trigger search and matching chatter. A FUZZY
+# trigger has to be at least fuzzy_threshold similar to a message (1.0 being
+# every word of it there, spelt right) before we'll say it.
+fuzzy_maxdist = 1
+fuzzy_prefix = 1
+fuzzy_threshold = 0.6
+
 types = defaultdict(partial(str, '?'), {
     'MATCHALL' : '=',
     'LITERAL' : '!',
     'FUZZY' : '~',
-    'CHANTYPES' : '#',
+    'CHANEVENT' : '#',
 })
 
 reversetypes = defaultdict(partial(str, 'UNKNOWN'), {v : k for k, v in types.items()})
 
-def make_query(text, querytype='trigger'):
-    return Or([FuzzyTerm(querytype, t) for t in text.split()]) 
-
-def filter_message(message):
-    return re.sub('[\-\$\+\~\?]', ' ', message.lower())
+def make_query(searcher, text, querytype='trigger', shard=None):
+    return expander.make_query(searcher.reader(), text, querytype, shard)
 
 def select_query(message, results):
-    newresults = []
-    message = filter_message(message)
-    for result in results:
-        querytype = result['querytype']
-        trigger = filter_message(result['trigger'])
-        if querytype == 'MATCHALL':
-            if trigger not in message: continue
-        elif querytype == 'LITERAL':
-            if trigger != message: continue
-        elif querytype == 'FUZZY':
-            # Fall through
-            pass
-        else:
-            continue
-
-        # XXX FIXME a hack for now!
-        response = result['response']
-        if result['useaction'] == True:
-            response = '\x01ACTION ' + response + '\x01'
-
-        newresults.append(response)
-
-    if not newresults: return None
-    return random.choice(newresults)
+    # The matcher has already done the type checks for us, and put the best
+    # first; just don't take anything too far off
+    return pick_response(results.above(fuzzy_threshold))
 
 def build_response(response, **kwargs):
     # safe dictionary building
@@ -90,17 +119,63 @@ class SockyIRCClient(client.IRCClient):
     def __init__(self, *args, **kwargs):
         client.IRCClient.__init__(self, *args, **kwargs)
 
-        self.quitmme = False
-        self.lastsaid = 0
-        self.db = kwargs.get('db', 'socky')
-
-        self.load_config()
+        self.setup_socky(**kwargs)
 
-        self.add_dispatch_in('PRIVMSG', 1000, self.handle_privmsg)
-        self.add_dispatch_in('JOIN', 1000, self.handle_join)
-        self.add_dispatch_in('QUIT', 1000, self.handle_exit)
-        self.add_dispatch_in('PART', 1000, self.handle_exit)
-        self.add_dispatch_in('KICK', 1000, self.handle_kick)
+    def setup_socky(self, **kwargs):
+        self.quitting = False
+        self.cooldowns = Cooldowns()
+        self.db = kwargs.get('db', 'socky')
+        self.completions = queue.Queue()
+        self.drainrun = 0
+        self.reconnects = 0
+
+        # The index side of things is shared with the other networks
+        self.searcher = searcher
+        self.writer = writer
+        self.workers = workers
+        self.metrics = metrics
+
+        # Config is per network, though
+        self.config = ConfigStore(self.db, {'interval' : default_interval,
+                                            'shutup' : default_shutup,
+                                            'scoped' : set()},
+                                  admins)
+
+        # Pending trigger search results, per requester
+        self.cursors = CursorStore(search_ttl)
+
+        # Everything we say goes through here
+        self.sendqueue = SendQueue(self, metrics=self.metrics)
+        self.metrics.gauge('send_queue_depth_' + re.sub(r'\W', '_', self.db),
+                           self.sendqueue.depth)
+
+        timed = self.metrics.timed
+        self.add_dispatch_in('PRIVMSG', 1000, timed('privmsg', self.handle_privmsg))
+        self.add_dispatch_in('JOIN', 1000, timed('join', self.handle_join))
+        # Not QUIT: its only param is the reason, and we don't know which
+        # channels they were in
+        self.add_dispatch_in('PART', 1000, timed('exit', self.handle_exit))
+        self.add_dispatch_in('KICK', 1000, timed('kick', self.handle_kick))
+        self.add_dispatch_in('001', 1000, self.handle_welcome)
+        self.timed_command = timed('command', self.handle_command)
+
+    def scope(self, target):
+        # Channel-scoped triggers only apply in channels, not in private
+        if not target: return None
+
+        target = self.nickchan_lower(target)
+        if target[0] not in self.isupport['CHANTYPES']: return None
+        return target
+
+    def spew_event(self, event, timer, nick, target):
+        response = matcher.event_response(event, self.scope(target))
+        if not response: return
+
+        response = build_response(response, who=nick, where=target,
+                                  mynick=self.current_nick)
+        sayfunc = partial(self.say, target, response, CHATTER)
+        self.timer_oneshot(timer, random.randint(10, 30) / 10, sayfunc)
+        self.metrics.incr('responses')
 
     def handle_join(self, discard, line):
         if not line.hostmask: return
@@ -114,15 +189,7 @@ class SockyIRCClient(client.IRCClient):
         # Don't trigger on ourselves
         if nick == self.current_nick: return
 
-        with ix.searcher() as searcher:
-            results = searcher.search(Term('querytype', 'JOIN'))
-            if len(results) == 0: return
-
-            response = random.choice(results)['response']
-            response = build_response(response, who=nick, where=target,
-                                      mynick=self.current_nick)
-            sayfunc = partial(self.cmdwrite, 'PRIVMSG', (target, response))
-            self.timer_oneshot('socky_joinspew', random.randint(10, 30) / 10, sayfunc)
+        self.spew_event('JOIN', 'socky_joinspew', nick, target)
 
     def handle_exit(self, discard, line):
         if not line.hostmask: return
@@ -136,15 +203,7 @@ class SockyIRCClient(client.IRCClient):
         # Don't trigger on ourselves
         if nick == self.current_nick: return
 
-        with ix.searcher() as searcher:
-            results = searcher.search(Term('querytype', 'EXIT'))
-            if len(results) == 0: return
-
-            response = random.choice(results)['response']
-            response = build_response(response, who=nick, where=target,
-                                      mynick=self.current_nick)
-            sayfunc = partial(self.cmdwrite, 'PRIVMSG', (target, response))
-            self.timer_oneshot('socky_exitspew', random.randint(10, 30) / 10, sayfunc)
+        self.spew_event('EXIT', 'socky_exitspew', nick, target)
 
     def handle_kick(self, discard, line):
         if not line.hostmask: return
@@ -156,21 +215,14 @@ class SockyIRCClient(client.IRCClient):
         # Don't trigger on ourselves
         if nick == self.current_nick: return
 
-        with ix.searcher() as searcher:
-            results = searcher.search(Term('querytype', 'EXIT'))
-            if len(results) == 0: return
-
-            response = random.choice(results)['response']
-            response = build_response(response, who=nick, where=target,
-                                    mynick=self.current_nick)
-            sayfunc = partial(self.cmdwrite, 'PRIVMSG', (target, response))
-            self.timer_oneshot('socky_exitspew', random.randint(10, 30) / 10,
-                            sayfunc)
+        self.spew_event('EXIT', 'socky_exitspew', nick, target)
 
     def handle_privmsg(self, discard, line):
         if len(line.params) <= 1: return
         if not line.hostmask: return
 
+        self.metrics.incr('messages')
+
         target = self.nickchan_lower(line.params[0])
         message = line.params[-1]
 
@@ -178,6 +230,12 @@ class SockyIRCClient(client.IRCClient):
         if target[0] not in self.isupport['CHANTYPES']:
             target = line.hostmask.nick
 
+        # Nothing to do in a channel that's cooling down, unless it's for us
+        cooling = not self.cooldowns.ready(target)
+        if cooling and self.current_nick not in message:
+            self.metrics.incr('suppressed')
+            return
+
         useaction = False
         if message.startswith('\x01'):
             # CTCP stripping
@@ -197,29 +255,41 @@ class SockyIRCClient(client.IRCClient):
                 newmessage = newmessage[1:]
 
             if newmessage:
-                self.handle_command(line, target, newmessage, useaction)
+                self.timed_command(line, target, newmessage, useaction)
                 return
 
-        # Check last said time
-        if time.time() - self.lastsaid < self.interval:
+        if cooling:
+            self.metrics.incr('suppressed')
             return
 
-        query = make_query(message)
+        self.metrics.incr('searches')
+        lookup = self.metrics.timed('match', partial(matcher.match, message,
+                                                     self.scope(target)))
+        callback = partial(self.privmsg_matched, line, target, message)
+        self.workers.submit(lookup, self.deferred(callback), CHATTER, shed=True)
 
-        with ix.searcher() as searcher:
-            results = searcher.search(query)
-            if len(results) == 0: return
+    def privmsg_matched(self, line, target, message, results, error):
+        if error:
+            print('Lookup failed:', error)
+            return
 
-            response = select_query(message, results)
-            if not response: return
+        # Something else may have been said while we were looking
+        if not self.cooldowns.ready(target):
+            self.metrics.incr('suppressed')
+            return
 
-            response = build_response(response, who=line.hostmask.nick,
-                                      where=target, mynick=self.current_nick)
+        response = select_query(message, results)
+        if not response: return
 
-        sayfunc = partial(self.cmdwrite, 'PRIVMSG', (target, response))
-        self.timer_oneshot('socky_spew', random.randint(10, 50) / 10, sayfunc)
+        response = build_response(response, who=line.hostmask.nick,
+                                  where=target, mynick=self.current_nick)
 
-        self.lastsaid = time.time()
+        sayfunc = partial(self.say, target, response, CHATTER)
+        self.timer_oneshot('socky_spew_' + target, random.randint(10, 50) / 10,
+                           sayfunc)
+        self.metrics.incr('responses')
+
+        self.cooldowns.hold(target, self.interval)
 
     def handle_command(self, line, target, message, useaction):
         nick = self.nickchan_lower(line.hostmask.nick)
@@ -249,6 +319,10 @@ class SockyIRCClient(client.IRCClient):
         # Split
         firstparam, type_, secondparam = parsed.groups()
         firstparam = firstparam.lower()
+
+        # Only commands get to leave the second portion empty
+        if not secondparam and type_ != '$': return
+
         # Replace bot's current nickname with a placeholder
         secondparam = secondparam.replace(self.nick, '{mynick}')
 
@@ -275,74 +349,226 @@ class SockyIRCClient(client.IRCClient):
             else:
                 return
         elif type_ == '$':
-            if firstparam == 'quit':
+            if firstparam == 'more':
+                self.handle_more(line, target)
+            elif firstparam == 'quit':
                 # Exit!
-                self.cmdwrite('PRIVMSG', (target, 'Adios'))
+                self.say(target, 'Adios')
                 self.quitme(secondparam)
             elif firstparam == 'reload':
                 # Reloading stuff
                 secondparam = secondparam.lower()
                 if secondparam.startswith('admin'):
-                    self.load_config()
-                    self.cmdwrite('PRIVMSG', (target, 'As you wish.'))
+                    sayfunc = partial(self.say, target, 'As you wish.')
+                    self.config.reload(self.deferred(sayfunc))
             elif firstparam == 'addadmin':
                 # Add an admin
                 secondparam = secondparam.lower()
                 self.add_admin(secondparam)
-                self.cmdwrite('PRIVMSG', (target, 'New boss added to the obedience file'))
+                self.say(target, 'New boss added to the obedience file')
             elif firstparam == 'deladmin':
                 # Delete an admin
                 secondparam = secondparam.lower()
                 self.del_admin(secondparam)
-                self.cmdwrite('PRIVMSG', (target, 'Boss has been removed from the obedience file'))
+                self.say(target, 'Boss has been removed from the obedience file')
             elif firstparam == 'setshutup':
                 try:
                     secondparam = int(secondparam)
                 except ValueError:
-                    self.cmdwrite('PRIVMSG', (target, 'No.'))
+                    self.say(target, 'No.')
                     return
 
                 self.set_shutup(secondparam)
-                self.cmdwrite('PRIVMSG', (target, 'The requisite adjustments are made.'))
+                self.say(target, 'The requisite adjustments are made.')
             elif firstparam == 'setinterval':
                 try:
                     secondparam = int(secondparam)
                 except ValueError:
-                    self.cmdwrite('PRIVMSG', (target, 'Don\'t think so'))
+                    self.say(target, 'Don\'t think so')
                     return
 
                 self.set_interval(secondparam)
-                self.cmdwrite('PRIVMSG', (target, 'My interval has been adjusted.'))
+                self.say(target, 'My interval has been adjusted.')
             elif firstparam == 'nickinfo' or firstparam == 'userinfo':
                 # Nick info
                 secondparam = self.nickchan_lower(secondparam)
                 if secondparam in self.users:
                     account = self.users[secondparam].account
                     if account and account != '*':
-                        self.cmdwrite('PRIVMSG', (target, 'User is logged in as: ' + account))
+                        self.say(target, 'User is logged in as: ' + account)
                     else:
-                        self.cmdwrite('PRIVMSG', (target, 'User is not logged in'))
+                        self.say(target, 'User is not logged in')
                 else:
-                     self.cmdwrite('PRIVMSG', (target, 'User is unknown to me'))
+                     self.say(target, 'User is unknown to me')
             elif firstparam == 'adminlist':
                 # Second parameter not used
                 if hasattr(self, 'admins'):
                     adminlist = ' '.join(self.admins)
-                    self.cmdwrite('PRIVMSG', (target, 'Admins: ' + adminlist))
+                    self.say(target, 'Admins: ' + adminlist)
                 else:
-                    self.cmdwrite('PRIVMSG', (target, 'No known admins'))
+                    self.say(target, 'No known admins')
             elif (firstparam.startswith('quiet') or firstparam.startswith('shut up')
                   or firstparam.startswith('shutup')):
                 # Shut up for elapsed time
-                self.lastsaid = time.time() + abs(self.shutup - self.interval)
-                self.cmdwrite('PRIVMSG', (target, 'Clammin\' it up!'))
+                self.cooldowns.hold(target, abs(self.shutup - self.interval) +
+                                    self.interval)
+                self.say(target, 'Clammin\' it up!')
             elif (firstparam.startswith('speak') or firstparam.startswith('talk')):
-                self.lastsaid = time.time() - self.interval
-                self.cmdwrite('PRIVMSG', (target, 'Yay! My muzzle is off!'))
+                self.cooldowns.release(target)
+                self.say(target, 'Yay! My muzzle is off!')
+            elif firstparam == 'stats':
+                self.handle_stats(target)
+            elif firstparam == 'scope':
+                self.handle_scope(target, secondparam.lower())
+            elif firstparam == 'swap':
+                self.handle_swap(target)
+            elif firstparam == 'profile':
+                self.handle_profile(target, secondparam)
+
+    def handle_scope(self, target, scope):
+        channel = self.scope(target)
+        if not channel:
+            self.say(target, 'Only channels get their own humour')
+            return
+
+        if scope == 'here':
+            self.config['scoped'] = self.config['scoped'] | {channel}
+            self.say(target, 'New humour stays in ' + channel)
+        elif scope in ('everywhere', 'global'):
+            self.config['scoped'] = self.config['scoped'] - {channel}
+            self.say(target, 'New humour goes everywhere')
+        elif channel in self.config['scoped']:
+            self.say(target, 'New humour added here stays here')
+        else:
+            self.say(target, 'New humour added here goes everywhere')
+
+    def handle_swap(self, target):
+        def done(error, message=None):
+            if error:
+                self.say(target, 'Swap failed: ' + str(error))
+            else:
+                self.say(target, message)
+
+        self.say(target, 'Swapping in ' + hive_path + ', hold on')
+        threading.Thread(target=swap_hive, args=(hive_path, self.deferred(done)),
+                         name='socky-swap', daemon=True).start()
+
+    def handle_profile(self, target, param):
+        # $ [profile] [start 60] / $ [profile] [stop]. Only one at a time,
+        # and only the network that started it can stop it, since cProfile is
+        # stuck to its thread. The worker gets one too, jobs being run in
+        # order; with more than one worker thread only one of them would.
+        words = param.lower().split()
+        if not words or words[0] == 'start':
+            try:
+                seconds = float(words[1]) if len(words) > 1 else profile_window
+            except ValueError:
+                self.say(target, 'Dumbass.')
+                return
+
+            seconds = min(max(seconds, 1), profile_max_window)
+            try:
+                run = profiler.start(self.db)
+            except RuntimeError as e:
+                self.say(target, str(e))
+                return
+
+            self.workers.submit(profiler.attach, None, ADMIN)
+            self.timer_oneshot('socky_profile_{}'.format(run), seconds,
+                               partial(self.profile_done, target, run))
+            self.say(target, 'Profiling for {:.0f} seconds'.format(seconds))
+        elif words[0] == 'stop':
+            if profiler.owner != self.db:
+                self.say(target, 'Not profiling here')
+                return
+
+            self.profile_done(target, profiler.runs)
+        else:
+            self.say(target, 'Dumbass.')
+
+    def profile_done(self, target, run):
+        # From the timer, unless somebody stopped it first
+        if not profiler.running or profiler.runs != run: return
+        if profiler.stopping: return
+
+        profiler.stopping = True
+        profiler.detach()
+        callback = partial(self.profile_report, target)
+        self.workers.submit(profiler.detach, self.deferred(callback), ADMIN)
+
+    def profile_report(self, target, result, error):
+        # Back on the read loop, once the worker has let go too
+        path = os.path.join(profile_dir, 'socky-{:%Y%m%d-%H%M%S}.pstats'.format(
+            datetime.now()))
+        stats, elapsed = profiler.finish(path)
+        self.say(target, 'Profiled {:.1f} seconds into {}'.format(elapsed,
+                                                                  path))
+
+        budget = byte_budget(self.current_nick, target)
+        for name, rows in (('top', top(stats, profile_top)),
+                           ('handlers', handlers(stats))):
+            items = ['{} {:.1f}ms/{}'.format(label, seconds * 1000, calls)
+                     for label, seconds, calls in rows]
+            if not items: continue
+
+            for line in pack_lines('[' + name + ' | ', items, ']', budget):
+                self.say(target, line)
+
+    def handle_stats(self, target):
+        get = self.metrics.get
+        privmsg = self.metrics.histograms.get('privmsg')
+        if privmsg:
+            latency = 'privmsg p50 {:.2f}ms p99 {:.2f}ms'.format(
+                privmsg.quantile(0.5) * 1000, privmsg.quantile(0.99) * 1000)
+        else:
+            latency = 'no privmsg timings yet'
+
+        stats = ('Seen {} messages, searched {}, said {}, held my tongue {} '
+                 'times; cache {}/{} hits; {}').format(
+                     get('messages'), get('searches'), get('responses'),
+                     get('suppressed'), get('matcher_cache_hits'),
+                     get('matcher_cache_hits') + get('matcher_cache_misses'),
+                     latency)
+        self.say(target, stats)
 
     def quitme(self, message=''):
-        self.quitme = True
-        self.cmdwrite('QUIT', (message,))
+        self.quitting = True
+        self.config.flush()
+        # Queued, so whatever we were saying goes out first
+        self.sendqueue.send('QUIT', (message,))
+
+    def say(self, target, text, priority=ADMIN):
+        self.sendqueue.send('PRIVMSG', (target, text), priority)
+
+    def deferred(self, callback):
+        # Callbacks from the worker, writer, config and swap threads get
+        # bounced back onto the read loop. The timers aren't ours to touch
+        # from other threads, so they go through a queue it drains.
+        return lambda *args: self.completions.put(partial(callback, *args))
+
+    def handle_welcome(self, discard, line):
+        # Start draining completions, once per connection; any loop left
+        # over from the last one stops itself
+        self.drainrun += 1
+        self.drain_completions(self.drainrun)
+
+    def drain_completions(self, run):
+        if self.quitting or run != self.drainrun: return
+
+        while True:
+            try:
+                callback = self.completions.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                callback()
+            except Exception as e:
+                print('Deferred callback failed:', e)
+
+        self.timer_oneshot('socky_completions_{}'.format(run),
+                           completion_interval,
+                           partial(self.drain_completions, run))
 
     def handle_triggeradd(self, line, target, trigger, type_, response, useaction):
         trigger = filter_message(trigger)
@@ -355,282 +581,606 @@ class SockyIRCClient(client.IRCClient):
             else:
                 return
 
-        writer = ix.writer()
         try:
             account = self.users[self.nickchan_lower(line.hostmask.nick)].account
-            writer.add_document(trigger=trigger, querytype=type_,
-                                response=response, useaction=useaction,
-                                who=account, time=datetime.now())
         except Exception as e:
-            self.cmdwrite('PRIVMSG', (target, 'Error: ' + str(e)))
+            self.say(target, 'Error: ' + str(e))
             return
 
-        writer.commit()
-        if useaction:
-            self.ctcpwrite(target, 'ACTION', 'your humour has been added to the hive')
-        else:
-            self.cmdwrite('PRIVMSG', (target, 'Your humour has been added to the hive'))
+        fields = dict(trigger=trigger, querytype=type_, response=response,
+                      useaction=useaction, who=account, time=datetime.now())
 
-    def handle_triggersearch(self, line, target, searchterm):
-        limit = 425 # rather arbitrary
+        channel = self.scope(target)
+        if channel in self.config['scoped']:
+            fields['channel'] = channel
 
-        responses = OrderedDict()
+        # The matcher changes along with the journal, under its lock, so a
+        # snapshot never sees one without the other
+        with matcher.lock:
+            if swapping:
+                self.say(target, 'Hang on, I\'m swapping hives')
+                return
 
-        query = make_query(searchterm)
-        with ix.searcher() as searcher:
-            results = searcher.search(query)
-            if len(results) == 0:
-                self.cmdwrite('PRIVMSG', (target, 'Drawing a blank here :/'))
+            exact, near = matcher.duplicates(fields)
+            if exact:
+                self.metrics.incr('duplicates_rejected')
+                self.say(target, 'That humour is already in the hive')
                 return
 
-            responses = OrderedDict()
-            for index, result in enumerate(results):
-                trigger = result['trigger']
-                response = result['response']
-                querytype = result['querytype']
-                who = 'Unknown' if not result['who'] else result['who']
-                time = 'Unknown' if not result['time'] else result['time'].ctime()
-                useaction = '* ' if result['useaction'] else ''
-
-                querytype = types[querytype]
-
-                docnum = results.docnum(index)
-
-                if trigger not in responses:
-                    responses[trigger] = list()
-
-                responses[trigger].append((docnum, response, querytype, useaction,
-                                           who, time))
-
-        # Iterate through responses
-        for k, v in responses.items():
-            start = '[' + k + ' | '
-            curstr = start
-            for x in v:
-                docnum, response, querytype, useaction, who, time = x
-                new = '{d} {{{w} - {t}}}: {q} {u}{r} & '.format(d=docnum, q=querytype,
-                                                                u=useaction, r=response,
-                                                                w=who, t=time)
-                if len(curstr) + len(new) > limit:
-                    curstr = curstr[:-3]
-                    curstr += ']'
-                    self.cmdwrite('PRIVMSG', (target, curstr))
-                    curstr = start
-
-                curstr += new
-
-            if curstr != start:
-                curstr = curstr[:-3]
-                curstr += ']'
-                self.cmdwrite('PRIVMSG', (target, curstr))
+            callback = partial(self.triggeradd_done, target, fields, near)
+            self.writer.add_document(fields, self.deferred(callback))
+            matcher.add(fields)
 
-    def handle_triggersearch_event(self, line, target, event, searchterm):
-        limit = 425 # rather arbitrary
+    def triggeradd_done(self, target, fields, near, error):
+        if error:
+            self.say(target, 'Error: ' + str(error))
+            return
 
-        event = event.upper()
-        print('Searching event', event)
-        query = And([make_query(searchterm, 'response'), Term('querytype', event)])
-        with ix.searcher() as searcher:
-            results = searcher.search(query)
-            if len(results) == 0:
-                self.cmdwrite('PRIVMSG', (target, 'I\'ve got nothing :/'))
-                return
+        if fields['useaction']:
+            self.say(target, '\x01ACTION your humour has been added to the hive\x01')
+        else:
+            self.say(target, 'Your humour has been added to the hive')
 
-            start = '[' + event.lower() + ' | '
-            curstr = start
-            for index, result in enumerate(results):
-                response = result['response']
-                querytype = result['querytype']
-                who = 'Unknown' if not result['who'] else result['who']
-                time = 'Unknown' if not result['time'] else result['time'].ctime()
-                useaction = '* ' if result['useaction'] else ''
+        if near:
+            self.metrics.incr('near_duplicates')
+            budget = byte_budget(self.current_nick, target)
+            items = [t.response for t in near[:5]]
+            for line in pack_lines('[looks a lot like | ', items, ']', budget):
+                self.say(target, line)
 
-                docnum = results.docnum(index)
+    def handle_triggersearch(self, line, target, searchterm):
+        self.start_search(line, target, Cursor('text', searchterm,
+                                               self.scope(target)))
 
-                new = '{d} {{{w} - {t}}}: # {u}{r} & '.format(d=docnum, u=useaction,
-                                                              r=response, w=who,
-                                                              t=time)
+    def handle_triggersearch_event(self, line, target, event, searchterm):
+        event = event.upper()
+        print('Searching event', event)
+        self.start_search(line, target, Cursor(event, searchterm,
+                                               self.scope(target)))
+
+    def handle_more(self, line, target):
+        requester = self.nickchan_lower(line.hostmask.nick)
+        cursor = self.cursors.get(requester)
+        if not cursor:
+            self.say(target, 'Nothing more to show you')
+            return
 
-                if len(curstr) + len(new) > limit:
-                    curstr = curstr[:-3]
-                    curstr += ']'
-                    self.cmdwrite('PRIVMSG', (target, curstr))
-                    curstr = start
+        self.start_search(line, target, cursor)
+
+    def start_search(self, line, target, cursor):
+        requester = self.nickchan_lower(line.hostmask.nick)
+        search = self.metrics.timed('search', partial(self.fetch_page, cursor))
+        callback = partial(self.say_page, target, requester, cursor)
+        self.workers.submit(search, self.deferred(callback), ADMIN)
+
+    def fetch_page(self, cursor):
+        # Runs in the worker. Text searches look at every shard in scope,
+        # event searches only at that event's.
+        if cursor.query is None:
+            querytypes = None if cursor.kind == 'text' else (cursor.kind,)
+            field = 'trigger' if cursor.kind == 'text' else 'response'
+
+            cursor.query = {}
+            for key in hive.route(querytypes, cursor.channel):
+                cursor.query[key] = make_query(self.searcher.get(key),
+                                               cursor.searchterm, field, key)
+
+        # Scores from different shards aren't strictly comparable, but close
+        # enough to interleave. Each shard only has to find its best pagenum
+        # pages' worth, and only this page's stored fields get loaded.
+        limit = cursor.pagenum * search_pagelen
+        hits = []
+        total = 0
+        for key, query in cursor.query.items():
+            results = self.searcher.get(key).search(query, limit=limit)
+            total += len(results)
+            hits.extend((hit.score, key, hit) for hit in results)
+
+        hits.sort(key=lambda h: h[0], reverse=True)
+        start = (cursor.pagenum - 1) * search_pagelen
+        pagecount = (total + search_pagelen - 1) // search_pagelen
+
+        rows = []
+        for score, key, hit in hits[start:start + search_pagelen]:
+            who = 'Unknown' if not hit.get('who') else hit['who']
+            time = 'Unknown' if not hit.get('time') else hit['time'].ctime()
+            useaction = '* ' if hit['useaction'] else ''
+            docid = '{}:{}'.format(shard_label(key), hit.docnum)
+
+            rows.append((hit['trigger'], docid, hit['response'],
+                         types[hit['querytype']], useaction, who, time))
+
+        return rows, pagecount
+
+    def say_page(self, target, requester, cursor, result, error):
+        if error:
+            self.say(target, 'Error: ' + str(error))
+            return
 
-                curstr += new
+        rows, pagecount = result
+        if not rows:
+            self.cursors.pop(requester)
+            if cursor.kind == 'text':
+                self.say(target, 'Drawing a blank here :/')
+            else:
+                self.say(target, 'I\'ve got nothing :/')
+            return
 
-            if curstr != start:
-                curstr = curstr[:-3]
-                curstr += ']'
-                self.cmdwrite('PRIVMSG', (target, curstr))
+        if cursor.kind == 'text':
+            self.say_triggers(target, rows)
+        else:
+            self.say_events(target, cursor.kind, rows)
 
-    def handle_triggerdel_single(self, line, target, num):
-        if not isinstance(num, int):
-            try:
-                num = int(num)
-            except ValueError:
-                self.cmdwrite('PRIVMSG', (target, 'Dumbass.'))
-                return
+        if cursor.pagenum < pagecount:
+            self.say(target, 'Page {} of {}; [more] $ [] for the next one'.format(
+                cursor.pagenum, pagecount))
+            cursor.pagenum += 1
+            self.cursors.put(requester, cursor)
+        else:
+            self.cursors.pop(requester)
 
-        writer = ix.writer()
-        try:
-            writer.delete_document(num)
-        except Exception as e:
-            self.cmdwrite('PRIVMSG', (target, 'Error: ' + str(e)))
+    def say_triggers(self, target, rows):
+        responses = OrderedDict()
+        for trigger, docnum, response, querytype, useaction, who, time in rows:
+            if trigger not in responses:
+                responses[trigger] = list()
+
+            responses[trigger].append('{d} {{{w} - {t}}}: {q} {u}{r}'.format(
+                d=docnum, q=querytype, u=useaction, r=response, w=who, t=time))
+
+        budget = byte_budget(self.current_nick, target)
+        for k, items in responses.items():
+            for line in pack_lines('[' + k + ' | ', items, ']', budget):
+                self.say(target, line)
+
+    def say_events(self, target, event, rows):
+        items = []
+        for trigger, docnum, response, querytype, useaction, who, time in rows:
+            items.append('{d} {{{w} - {t}}}: # {u}{r}'.format(d=docnum, u=useaction,
+                                                             r=response, w=who,
+                                                             t=time))
+
+        budget = byte_budget(self.current_nick, target)
+        for line in pack_lines('[' + event.lower() + ' | ', items, ']', budget):
+            self.say(target, line)
+
+    def handle_triggerdel_single(self, line, target, docid):
+        # Search results number them shard:docnum, e.g. literal:42
+        label, sep, num = docid.strip().rpartition(':')
+        if not sep:
+            self.say(target, 'Which one? Give me the id from a search')
             return
 
-        writer.commit()
-        self.cmdwrite('PRIVMSG', (target, 'Humour has been removed from the hive'))
-
-    def handle_triggerdel_all(self, line, target, trigger):
-        writer = ix.writer()
         try:
-            writer.delete_by_term('trigger', trigger)
-        except Exception as e:
-            self.cmdwrite('PRIVMSG', (target, 'Error: ' + str(e)))
+            num = int(num)
+        except ValueError:
+            self.say(target, 'Dumbass.')
             return
 
-        writer.commit()
-        self.cmdwrite('PRIVMSG', (target, 'Humour has been purged from the hive'))
-
-    def load_config(self):
-        s = shelve.open(self.db)
+        key = parse_label(label)
 
-        self.load_admins(s)
-        self.load_interval(s)
-        self.load_shutup(s)
+        lookup = self.metrics.timed('search', lambda: [
+            self.searcher.get(key).stored_fields(num)])
+        delete = lambda removed, callback: self.writer.delete_document(
+            num, callback, removed[0])
+        callback = partial(self.triggerdel_queue, target, delete,
+                           'Humour has been removed from the hive', hive)
+        self.workers.submit(lookup, self.deferred(callback), ADMIN)
 
-        s.close()
-
-    def load_interval(self, handle=None):
-        if not handle:
-            s = shelve.open(self.db)
-        else:
-            s = handle
+    def handle_triggerdel_all(self, line, target, trigger):
+        lookup = self.metrics.timed('search', lambda: [
+            fields for key in hive.keys()
+            for fields in self.searcher.get(key).documents(trigger=trigger)])
+        delete = lambda removed, callback: self.writer.delete_by_term(
+            'trigger', trigger, callback)
+        callback = partial(self.triggerdel_queue, target, delete,
+                           'Humour has been purged from the hive', hive)
+        self.workers.submit(lookup, self.deferred(callback), ADMIN)
+
+    def triggerdel_queue(self, target, delete, message, searched, removed,
+                         error):
+        if error:
+            self.say(target, 'Error: ' + str(error))
+            return
 
-        if 'interval' not in s:
-            self.interval = s['interval'] = default_interval
-        else:
-            self.interval = s['interval']
+        callback = partial(self.triggerdel_done, target, removed, message)
+        with matcher.lock:
+            if swapping:
+                self.say(target, 'Hang on, I\'m swapping hives')
+                return
+            elif searched is not hive:
+                # Document numbers are no good in a different hive
+                self.say(target, 'The hive changed under me, try again')
+                return
 
-        if not handle:
-            s.close()
+            delete(removed, self.deferred(callback))
+            for fields in removed:
+                matcher.remove(fields)
 
-    def set_interval(self, interval):
-        s = shelve.open(self.db)
+    def triggerdel_done(self, target, removed, message, error):
+        if error:
+            self.say(target, 'Error: ' + str(error))
+            return
 
-        self.interval = s['interval'] = interval
+        self.say(target, message)
 
-        s.close()
+    @property
+    def interval(self):
+        return self.config['interval']
 
-    def load_shutup(self, handle=None):
-        if not handle:
-            s = shelve.open(self.db)
-        else:
-            s = handle
+    @property
+    def shutup(self):
+        return self.config['shutup']
 
-        if 'shutup' not in s:
-            self.shutup = s['shutup'] = default_shutup
-        else:
-            self.shutup = s['shutup']
+    @property
+    def admins(self):
+        return self.config.admins
 
-        if not handle:
-            s.close()
+    def set_interval(self, interval):
+        self.config['interval'] = interval
 
     def set_shutup(self, shutup):
-        s = shelve.open(self.db)
-
-        self.shutup = s['shutup'] = shutup
+        self.config['shutup'] = shutup
 
-        s.close()
-
-    def load_admins(self, handle=None):
-        # Bootstrap admins
-        self.admins = set([x.lower() for x in admins])
+    def add_admin(self, admin):
+        self.config.add_admin(admin)
 
-        if not handle:
-            s = shelve.open(self.db)
-        else:
-            s = handle
+    def del_admin(self, admin):
+        self.config.del_admin(admin)
 
-        if 'admins' not in s:
-            s['admins'] = set()
+def reconnect_delay(attempt):
+    # Full jitter, so a netsplit doesn't have every bot knocking at once
+    return random.uniform(0, min(reconnect_cap, reconnect_base * 2 ** attempt))
 
-        self.admins = self.admins.union(s['admins'])
+def run(instance):
+    try:
+        generator = instance.get_lines()
+        for line in generator:
+            instance.reconnects = 0
+    except (OSError, IOError) as e:
+        if instance.quitting: return
+        delay = reconnect_delay(instance.reconnects)
+        instance.reconnects += 1
+        print("Disconnected", str(e), "- retrying in", round(delay, 1))
+        time.sleep(delay)
 
-        if not handle:
-            s.close()
+def serve(network):
+    instance = SockyIRCClient(**network)
 
-    def add_admin(self, admin):
-        s = shelve.open(self.db)
-        if 'admins' not in s:
-            newadmins = set()
-        else:
-            newadmins = s['admins']
-
-        admin = admin.lower()
+    while not instance.quitting:
+        try:
+            run(instance)
+        except BaseException as e:
+            print('Exception caught:', e)
+            instance.terminate()
+            raise
+
+# One entry per network, each with its own config db
+networks = [
+    {
+        'nick' : 'Socky',
+        'host' : 'okami.interlinked.me',
+        'port' : 6667,
+        'channels' : ['#sporks'],
+        'use_sasl' : True,
+        'sasl_username' : 'Socky',
+        'sasl_pw' : 'changeme',
+        'db' : 'interlinked',
+    },
+]
+
+snapshot_timer = None
+snapshot_lock = threading.Lock()
+snapshot_generation = None
+
+# The hive generation the matcher has caught up with, shard label ->
+# generation: what it was built from, moved along by our own commits. If the
+# hive has moved on anywhere else, another process has been at it.
+matcher_generation = None
+
+profiler = Profiler()
+
+# Where the hive lives, and what that was when we opened it
+hive_path = None
+hive_identity = None
+swap_timer = None
+swapping = False
+
+def identity(path):
+    # Changes when path is flipped to another directory, either by symlink or
+    # by renaming things about
+    st = os.stat(path)
+    return (os.path.realpath(path), st.st_dev, st.st_ino)
+
+def setup(path='index'):
+    global hive, matcher, expander, searcher, writer, workers, metrics
+    global snapshot_generation, matcher_generation, hive_path, hive_identity
+
+    hive_path = path
+    hive = open_hive(path)
+    hive_identity = identity(path)
+    expander = QueryExpander(fuzzy_maxdist, fuzzy_prefix)
+
+    # Trigger changes are journalled, then committed in batches in the
+    # background. Anything we didn't get to last time goes in first.
+    writer = BatchWriter(hive, journal=Journal(path + '.journal'))
+    replayed = writer.replay()
+    if replayed: print('Replayed', replayed, 'journalled changes')
+
+    # Load the matcher from the snapshot if it's still current, else build it
+    # from the hive
+    generation = hive.latest_generation()
+    matcher_generation = dict(generation)
+    matcher = load_snapshot(path + '.snapshot', generation, hive_identity)
+    if matcher is not None and (
+            matcher.fuzzyindex.maxdist != fuzzy_maxdist or
+            matcher.fuzzyindex.prefixlength != fuzzy_prefix):
+        matcher = None
+    if matcher is None:
+        matcher = TriggerMatcher.from_hive(hive, fuzzy_maxdist=fuzzy_maxdist,
+                                           fuzzy_prefix=fuzzy_prefix)
+    else:
+        print('Loaded matcher snapshot')
+        snapshot_generation = (hive_identity, generation)
+
+    report = matcher.memory()
+    print('Matcher holds {} triggers, {:.1f} bytes each all in; the table is '
+          '{:.1f} of that ({:.1f} overhead)'.format(
+              report['live'], report['bytes_per_trigger'],
+              report['table']['bytes_per_trigger'],
+              report['table']['overhead_per_trigger']))
+
+    # Shared by every handler that reads the index
+    searcher = ShardedSearcher(hive)
+
+    writer.on_commit = committed
+
+    metrics = Metrics()
+
+    # Index and matcher lookups happen off the read loops
+    workers = WorkerPool(metrics=metrics)
+
+    metrics.gauge('matcher_cache_hits', lambda: matcher.cache.hits)
+    metrics.gauge('matcher_cache_misses', lambda: matcher.cache.misses)
+    # Just the table; the whole matcher is too slow to measure every time
+    metrics.gauge('matcher_table_bytes',
+                  lambda: matcher.table.memory()['total_bytes'])
+    metrics.gauge('matcher_table_bytes_per_trigger',
+                  lambda: matcher.table.memory()['bytes_per_trigger'])
+    metrics.gauge('expander_cache_hits', lambda: expander.hits)
+    metrics.gauge('expander_cache_misses', lambda: expander.misses)
+    metrics.gauge('searcher_hits', lambda: searcher.hits)
+    metrics.gauge('searcher_refreshes', lambda: searcher.refreshes)
+    metrics.gauge('hive_shards', lambda: len(hive.keys()))
+    metrics.gauge('profiling', lambda: int(profiler.running))
+    metrics.gauge('writer_commits', lambda: writer.commits)
+    metrics.gauge('worker_queue_depth', workers.depth)
+    metrics.gauge('worker_shed', lambda: workers.shed)
+
+def committed(moved):
+    # From the writer thread. The matcher had these changes before they went
+    # in, so it's caught up with each shard as long as nobody else got there
+    # first.
+    with matcher.lock:
+        for key, (before, after) in moved.items():
+            label = shard_label(key)
+            if matcher_generation.get(label, 0) == before:
+                matcher_generation[label] = after
+
+    # And searches should see them straight away, not whenever the searchers
+    # next look
+    searcher.invalidate()
+
+def rebuild_matcher():
+    # Somebody else has changed the hive, so the matcher is missing that.
+    # It's built off to the side, and only swapped in if none of our own
+    # changes came along meanwhile; if they did, it's tried again next time.
+    global matcher, matcher_generation
+
+    old = matcher
+    with old.lock:
+        if swapping or not writer.idle(): return False
+        changes = old.generation
+        generation = dict(hive.latest_generation())
+
+    start = time.time()
+    fresh = TriggerMatcher.from_hive(hive, fuzzy_maxdist=fuzzy_maxdist,
+                                     fuzzy_prefix=fuzzy_prefix)
+
+    with old.lock:
+        if (swapping or matcher is not old or old.generation != changes or
+                not writer.idle()):
+            return False
+
+        matcher, matcher_generation = fresh, generation
+
+    print('Hive was changed elsewhere, rebuilt the matcher in {:.2f} '
+          'seconds'.format(time.time() - start))
+    return True
+
+def take_snapshot(path='index', rebuild=True):
+    global snapshot_generation
+
+    # The timer and shutdown can both get here
+    with snapshot_lock:
+        # Only once everything queued is in the index, or the generation we
+        # tag it with would be a lie. Just the copy is made under the lock,
+        # pickling and writing it out aren't.
+        with matcher.lock:
+            if not writer.idle(): return False
+
+            tag = (hive_identity, hive.latest_generation())
+            stale = dict(tag[1]) != matcher_generation
+            if not stale:
+                if tag == snapshot_generation: return False
+                copied = matcher.snapshot()
+
+        if stale:
+            # The matcher is missing somebody else's changes, so it doesn't
+            # go out as this generation; catch it up and the next one can
+            if rebuild: rebuild_matcher()
+            return False
 
-        newadmins.add(admin)
-        s['admins'] = newadmins
-        s.close()
+        try:
+            data = dump_snapshot(copied, tag[1], tag[0])
+        except pickle.PicklingError as e:
+            print('Snapshot failed:', e)
+            return False
 
-        self.admins.add(admin) 
+        try:
+            write_snapshot(data, path + '.snapshot')
+        except OSError as e:
+            print('Snapshot failed:', e)
+            return False
+
+        snapshot_generation = tag
+        return True
+
+def start_snapshots(path='index', interval=snapshot_interval):
+    global snapshot_timer
+
+    take_snapshot(path)
+    snapshot_timer = threading.Timer(interval, start_snapshots,
+                                     (path, interval))
+    snapshot_timer.daemon = True
+    snapshot_timer.start()
+
+def stop_snapshots():
+    if snapshot_timer: snapshot_timer.cancel()
+
+def swap_hive(path, callback=None):
+    # Switch to whatever hive is at path now, e.g. after schemaconvert.py or
+    # shardhive.py have flipped it, without stopping. The new one is opened,
+    # caught up and warmed here in the background; then the handlers are
+    # moved over in one go, from the worker so no search sees half of each.
+    # Trigger changes are turned away until it's done.
+    global swapping
+
+    with matcher.lock:
+        if swapping:
+            if callback: callback(RuntimeError('Already swapping'))
+            return
+        swapping = True
 
-    def del_admin(self, admin):
-        s = shelve.open(self.db)
-        if 'admins' not in s: return
+    start = time.time()
+    oldhive = hive
+    try:
+        newhive = open_hive(path)
+        newidentity = identity(path)
+
+        # Writes go to the new hive from here on
+        replayed = writer.swap(newhive)
+
+        newgeneration = dict(newhive.latest_generation())
+        newmatcher = TriggerMatcher.from_hive(newhive,
+                                              fuzzy_maxdist=fuzzy_maxdist,
+                                              fuzzy_prefix=fuzzy_prefix)
+        newsearcher = ShardedSearcher(newhive)
+        newsearcher.warm()
+    except Exception as e:
+        if writer.hive is not oldhive:
+            writer.swap(oldhive)
+        with matcher.lock:
+            swapping = False
+
+        print('Swap failed:', e)
+        if callback: callback(e)
+        return
+
+    def replace():
+        global hive, matcher, hive_identity, snapshot_generation, swapping
+        global matcher_generation
+
+        with matcher.lock:
+            old = searcher.replace(newsearcher)
+            expander.reset()
+            hive, matcher = newhive, newmatcher
+            hive_identity = newidentity
+            matcher_generation = newgeneration
+            snapshot_generation = None
+            swapping = False
+
+        for shared in old.values():
+            shared.close()
+        oldhive.close()
+
+    def replaced(result, error):
+        if error:
+            print('Swap failed:', error)
+            if callback: callback(error)
+            return
 
-        admin = admin.lower()
+        message = ('Swapped in {} ({} triggers, {} recent changes caught up) '
+                   'in {:.2f} seconds').format(path, len(newmatcher.table),
+                                               replayed, time.time() - start)
+        print(message)
+        if callback: callback(None, message)
 
-        if admin not in admins:
-            # Don't discard the bootstrapped admins!
-            self.admins.discard(admin)
+    workers.submit(replace, replaced, ADMIN)
 
-        newadmins = s['admins']
-        newadmins.discard(admin)
-        s['admins'] = newadmins
-        s.close()
+def watch_hive(path, interval=swap_check_interval):
+    global swap_timer
 
-def run(instance):
     try:
-        generator = instance.get_lines()
-        for line in generator: pass
-    except (OSError, IOError) as e:
-        if instance.quitme: quit()
-        print("Disconnected", str(e))
-        time.sleep(5)
-
-kwargs = {
-    'nick' : 'Socky',
-    'host' : 'okami.interlinked.me',
-    'port' : 6667,
-    'channels' : ['#sporks'],
-    'use_sasl' : True,
-    'sasl_username' : 'Socky',
-    'sasl_pw' : 'changeme',
-    'db' : 'interlinked',
-}
-
-# Initalise the DB or create it
-if not os.path.exists("index"):
-    analyzer = RegexTokenizer('[\w:;=]+') | LowercaseFilter()
-    trigtype = TEXT(stored=True, chars=True, vector=True, analyzer=analyzer)
-    schema = Schema(trigger=trigtype, querytype=ID(stored=True),
-                    useaction=BOOLEAN(stored=True),
-                    response=TEXT(stored=True, chars=True),
-                    who=ID(stored=True), time=NUMERIC(stored=True))
-    os.mkdir("index")
-    ix = create_in("index", schema)
-else:
-    ix = open_dir("index")
-
-instance = SockyIRCClient(**kwargs)
-
-while True:
-    try:
-        run(instance)
-    except BaseException as e:
-        print('Exception caught:', e)
-        instance.terminate()
-        raise
+        changed = identity(path) != hive_identity
+    except OSError:
+        # Caught mid-flip, most likely
+        changed = False
+
+    if changed and not swapping:
+        print('Hive at', path, 'has changed, swapping')
+        swap_hive(path)
+
+    swap_timer = threading.Timer(interval, watch_hive, (path, interval))
+    swap_timer.daemon = True
+    swap_timer.start()
+
+def stop_watching():
+    if swap_timer: swap_timer.cancel()
+
+def shutdown(path='index'):
+    metrics.stop_writer()
+    stop_snapshots()
+    stop_watching()
+    workers.close()
+    writer.close()
+
+    # Everything's committed now, so this one is as fresh as it gets. Not
+    # worth rebuilding for, the next start will do that anyway.
+    take_snapshot(path, rebuild=False)
+
+def main(path='index'):
+    setup(path)
+    metrics.start_writer(metrics_file, metrics_interval)
+    start_snapshots(path)
+    if swap_check_interval: watch_hive(path)
+
+    # Each network gets its own read loop; everything else is shared
+    threads = []
+    for network in networks:
+        thread = threading.Thread(target=serve, args=(network,),
+                                  name=network['host'], daemon=True)
+        thread.start()
+        threads.append(thread)
 
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        shutdown(path)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser(description='Run the bot')
+    argparser.add_argument('--index', default='index',
+                           help='hive directory')
+    argparser.add_argument('--server', default=None,
+                           help='HOST[:PORT] to connect to instead of what '
+                           'the networks say, e.g. loadtest.py\'s')
+    args = argparser.parse_args()
+
+    if args.server:
+        host, _, port = args.server.partition(':')
+        for network in networks:
+            network.update(host=host, port=int(port or 6667))
+
+    main(args.index)
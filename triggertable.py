@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Columnar trigger storage for the matcher. A namedtuple of four strings is a
+# few hundred bytes once you count the objects behind it; here a trigger is a
+# querytype code, a bit, and two offsets into one big UTF-8 blob. Rows are
+# numbered in the order they were added and never move until a rebuild.
+
+from array import array
+from copy import copy
+import sys
+
+class TriggerTable:
+    def __init__(self):
+        self.querytypes = []        # code -> querytype, interned
+        self.codes = {}             # querytype -> code
+        self.channels = [None]      # code -> channel scope, 0 is everywhere
+        self.channelcodes = {None : 0}
+
+        self.types = array('B')     # querytype code per row
+        self.scopes = array('H')    # channel code per row
+        self.actions = bytearray()  # useaction, a bit per row
+        self.live = bytearray()     # still there, a bit per row
+
+        # Row i is blob[starts[i]:splits[i]] for the trigger and
+        # blob[splits[i]:starts[i + 1]] for the response
+        self.blob = bytearray()
+        self.starts = array('I', [0])
+        self.splits = array('I')
+
+        self.count = 0
+        self.dead = 0
+        self.scopedcount = 0        # live rows scoped to a channel
+
+    def __len__(self):
+        return self.count - self.dead
+
+    def copy(self):
+        # Nothing in here holds anything mutable, so copying each part will do
+        table = TriggerTable.__new__(TriggerTable)
+        table.__dict__ = {k : copy(v) for k, v in self.__dict__.items()}
+        return table
+
+    def setbit(self, bits, row, value):
+        byte, bit = divmod(row, 8)
+        if byte >= len(bits): bits.append(0)
+
+        if value:
+            bits[byte] |= 1 << bit
+        else:
+            bits[byte] &= ~(1 << bit)
+
+    def getbit(self, bits, row):
+        byte, bit = divmod(row, 8)
+        return bool(bits[byte] & (1 << bit))
+
+    def intern(self, values, codes, value):
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+
+        return code
+
+    def append(self, trigger, querytype, response, useaction, channel=None):
+        row = self.count
+        self.types.append(self.intern(self.querytypes, self.codes, querytype))
+        self.scopes.append(self.intern(self.channels, self.channelcodes,
+                                       channel))
+        self.setbit(self.actions, row, useaction)
+        self.setbit(self.live, row, True)
+        if self.scopes[row]: self.scopedcount += 1
+
+        self.blob += trigger.encode('utf-8')
+        self.splits.append(len(self.blob))
+        self.blob += response.encode('utf-8')
+        self.starts.append(len(self.blob))
+
+        self.count += 1
+        return row
+
+    def delete(self, row):
+        # The bytes stay put until the owner rebuilds
+        if not self.alive(row): return False
+
+        self.setbit(self.live, row, False)
+        self.dead += 1
+        if self.scopes[row]: self.scopedcount -= 1
+        return True
+
+    def alive(self, row):
+        return row < self.count and self.getbit(self.live, row)
+
+    def trigger(self, row):
+        return self.blob[self.starts[row]:self.splits[row]].decode('utf-8')
+
+    def response(self, row):
+        return self.blob[self.splits[row]:self.starts[row + 1]].decode('utf-8')
+
+    def querytype(self, row):
+        return self.querytypes[self.types[row]]
+
+    def useaction(self, row):
+        return self.getbit(self.actions, row)
+
+    def channel(self, row):
+        return self.channels[self.scopes[row]]
+
+    def scoped(self):
+        # Whether anything still here is scoped to a channel
+        return self.scopedcount > 0
+
+    def visible(self, rows, channel):
+        # Just the rows that apply everywhere or in channel
+        code = self.channelcodes.get(channel, 0)
+        scopes = self.scopes
+        return [row for row in rows if scopes[row] in (0, code)]
+
+    def rows(self):
+        return (row for row in range(self.count) if self.getbit(self.live, row))
+
+    def wasteful(self):
+        # Worth rebuilding once most of it is dead weight
+        return self.dead > 1024 and self.dead > len(self)
+
+    def memory(self):
+        columns = {
+            'types' : sys.getsizeof(self.types),
+            'scopes' : sys.getsizeof(self.scopes),
+            'actions' : sys.getsizeof(self.actions),
+            'live' : sys.getsizeof(self.live),
+            'starts' : sys.getsizeof(self.starts),
+            'splits' : sys.getsizeof(self.splits),
+            'blob' : sys.getsizeof(self.blob),
+        }
+        total = sum(columns.values())
+        rows = max(self.count, 1)
+
+        return {
+            'rows' : self.count,
+            'live' : len(self),
+            'text_bytes' : len(self.blob),
+            'total_bytes' : total,
+            'columns' : columns,
+            'bytes_per_trigger' : total / rows,
+            'overhead_per_trigger' : (total - len(self.blob)) / rows,
+        }
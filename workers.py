@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Worker pool for index work, so the IRC read loop never waits on a search.
+# Jobs are run in priority order (admin stuff before chatter), and chatter
+# lookups are simply dropped when the queue is backed up.
+
+from itertools import count
+import queue
+import threading
+import time
+
+ADMIN = 0
+CHATTER = 1
+
+class WorkerPool:
+    # Whoosh searchers aren't safe to share between threads, so unless the
+    # jobs bring their own, stick with one thread.
+
+    def __init__(self, threads=1, maxdepth=64, metrics=None):
+        self.maxdepth = maxdepth
+        self.queue = queue.PriorityQueue()
+        self.seq = count()
+        self.metrics = metrics
+
+        self.done = 0
+        self.shed = 0
+        self.errors = 0
+
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.run, daemon=True,
+                                      name='socky-worker-{}'.format(i))
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, func, callback, priority=CHATTER, shed=False):
+        # callback(result, error) is called from the worker thread
+        if shed and self.queue.qsize() >= self.maxdepth:
+            self.shed += 1
+            return False
+
+        self.queue.put((priority, next(self.seq), time.perf_counter(), func,
+                        callback))
+        return True
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def run(self):
+        while True:
+            priority, seq, queued, func, callback = self.queue.get()
+            if func is None: return
+
+            # How long it sat behind everything else
+            if self.metrics:
+                self.metrics.observe('worker_wait',
+                                     time.perf_counter() - queued)
+
+            result = error = None
+            try:
+                result = func()
+            except Exception as e:
+                self.errors += 1
+                error = e
+
+            self.done += 1
+            if callback:
+                try:
+                    callback(result, error)
+                except Exception as e:
+                    print('Worker callback failed:', e)
+
+    def close(self):
+        for thread in self.threads:
+            # Sorts after everything else, so pending jobs get done first
+            self.queue.put((float('inf'), next(self.seq), 0, None, None))
+
+        for thread in self.threads:
+            thread.join()
+
+class InlinePool:
+    # Same interface, but does the work right away. Handy for benchmarks.
+
+    def __init__(self):
+        self.done = self.shed = self.errors = 0
+
+    def submit(self, func, callback, priority=CHATTER, shed=False):
+        result = error = None
+        try:
+            result = func()
+        except Exception as e:
+            self.errors += 1
+            error = e
+
+        self.done += 1
+        if callback: callback(result, error)
+        return True
+
+    def depth(self):
+        return 0
+
+    def close(self):
+        pass